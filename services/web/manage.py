@@ -1,6 +1,11 @@
+import click
+import pandas as pd
 from flask.cli import FlaskGroup
 
-from project import app, db, User
+from project import app, db, CycleResult, User
+from project.ac_plot import load_config, load_cycles
+from project.tools.cycle_calendar import CycleCalendar
+from project.tools.reprocess import reprocess
 
 
 cli = FlaskGroup(app)
@@ -8,7 +13,10 @@ cli = FlaskGroup(app)
 
 @cli.command("create_db")
 def create_db():
-    db.drop_all()
+    # the cycle results are expensive to recalculate and survive restarts
+    keep = {CycleResult.__tablename__}
+    tables = [t for t in db.metadata.sorted_tables if t.name not in keep]
+    db.metadata.drop_all(db.engine, tables=tables)
     db.create_all()
     db.session.commit()
 
@@ -19,5 +27,24 @@ def seed_db():
     db.session.commit()
 
 
+@cli.command("reprocess")
+@click.argument("start_date")
+@click.argument("end_date")
+@click.option(
+    "--chambers", "-c", default=None, help="Comma separated chambers, default all."
+)
+@click.option(
+    "--workers", "-w", type=int, default=None, help="Processes, default all cores."
+)
+def reprocess_cycles(start_date, end_date, chambers, workers):
+    """Recalculate lag, r and validity from START_DATE to END_DATE."""
+    read_dict, push_dict = load_config()
+    table = CycleCalendar(load_cycles()).table(start_date, end_date)
+    chambers = [int(c) for c in chambers.split(",")] if chambers else table.chamber_ids()
+    rows = table.select(chambers, pd.Timestamp.now(tz="UTC")).frame()
+    results = reprocess(rows, read_dict, push_dict, workers, progress=click.echo)
+    click.echo(f"Done, {int(results['is_valid'].sum())}/{len(results)} valid.")
+
+
 if __name__ == "__main__":
     cli()
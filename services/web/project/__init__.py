@@ -32,6 +32,30 @@ class User(db.Model):
         self.email = email
 
 
+class CycleResult(db.Model):
+    __tablename__ = "cycle_results"
+
+    chamber = db.Column(db.Integer, primary_key=True)
+    # UTC
+    start = db.Column(db.DateTime, primary_key=True)
+    close_offset = db.Column(db.Integer, nullable=False)
+    open_offset = db.Column(db.Integer, nullable=False)
+    lagtime_s = db.Column(db.Float, nullable=False, default=0)
+    got_lag = db.Column(db.Boolean, nullable=False, default=False)
+    ch4_r = db.Column(db.Float)
+    co2_r = db.Column(db.Float)
+    ch4_r_offset = db.Column(db.Float)
+    co2_r_offset = db.Column(db.Float)
+    is_valid = db.Column(db.Boolean)
+    has_errors = db.Column(db.Boolean)
+    no_data_in_db = db.Column(db.Boolean)
+    manual_valid = db.Column(db.Boolean)
+    failed_rules = db.Column(db.String(128))
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.Index("ix_cycle_results_start", "start"),)
+
+
 @auth.verify_password
 def verify_password(username, password):
     if username in users and users[username] == password:
@@ -1,13 +1,21 @@
+from uuid import uuid4
+
 from dash import dcc, html
 import pandas as pd
 
 
-def create_layout(meas):
+def create_layout(start_date, end_date):
     graph_style = {"height": "300px", "width": "900px"}
     return html.Div(
         [
             html.Button("Previous", id="prev-button", n_clicks=0),
             html.Button("Next", id="next-button", n_clicks=0),
+            dcc.DatePickerRange(
+                id="date-range",
+                start_date=start_date,
+                end_date=end_date,
+                display_format="YYYY-MM-DD",
+            ),
             html.Div([dcc.Checklist(id="chamber-select")], id="chamber-buttons"),
             html.Div(id="measurement-info", style={"padding": "20px 0"}),
             html.Div(
@@ -21,6 +29,7 @@ def create_layout(meas):
                     html.Button("Mark valid", id="mark-valid", n_clicks=0),
                     html.Button("Reset open and close", id="reset-cycle", n_clicks=0),
                     html.Button("Jump to beginning", id="reset-index"),
+                    html.Button("Calculate fluxes", id="calc-flux", n_clicks=0),
                 ],
                 style={"margin-bottom": "10px"},
             ),
@@ -48,6 +57,7 @@ def create_layout(meas):
                                         ),
                                         style={"width": "787px", "margin-left": "20px"},
                                     ),
+                                    html.Div(id="slide-stats"),
                                 ]
                             ),
                             html.Div(
@@ -81,8 +91,14 @@ def create_layout(meas):
                 style={"display": "flex"},
             ),
             html.Div(id="output"),
-            dcc.Store(id="stored-index", data=0),
-            dcc.Store(id="stored-chamber", data="All"),
+            # per tab, the dashboard state itself is kept on the server
+            dcc.Store(id="session-id", storage_type="session", data=str(uuid4())),
             dcc.Store(id="relayout-data", data=None),
+            # the selected cycle, changes whenever the cycle or its state does
+            dcc.Store(id="cycle-rev", data=None),
+            # samples of the cycle for the slide stats while dragging
+            dcc.Store(id="slide-data", data=None),
+            dcc.Store(id="tail-ts", data=None),
+            dcc.Interval(id="tail-interval", interval=60 * 1000),
         ]
     )
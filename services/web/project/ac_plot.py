@@ -1,22 +1,101 @@
 import dash
 from dash import Dash, dcc, html, Input, Output, State, ctx
 import dash_auth
+import numpy as np
 import pandas as pd
 import json
 from datetime import datetime, timedelta
 from plotly.graph_objs import Figure
 from pprint import pprint
 import logging
-import plotly.graph_objs as go
 import temp_users
 
 from project.ac_layout import create_layout
 from project.tools.logger import init_logger
-from project.tools.measurement import MeasurementCycle
-from project.tools.influxdb_funcs import init_client, ifdb_push
-from project.tools.create_graph import mk_gas_plot, mk_lag_plot
-
-lag_graph_dir = False
+from project.tools.measurement import bulk_get_data, LICOR_MEAS
+from project.tools.cycle_calendar import CycleCalendar
+from project.tools.tail_follow import TailFollower
+from project.tools.influxdb_funcs import ifdb_push
+from project.tools.client_pool import get_client
+from project.tools.ifdb_writer import get_writer
+from project.tools.create_graph import (
+    CLOSE_TRACE,
+    OPEN_TRACE,
+    mk_flux_plot,
+    mk_gas_plot,
+    mk_lag_plot,
+    patch_gas_plot,
+    patch_lag_highlighter,
+)
+from project.tools.flux_pipeline import MET_MEAS, cycle_met, load_flux_table
+from project.tools.gas_funcs import calculate_gas_fluxes
+from project.tools.results_store import load_into_table, refresh_cycle, save_cycles
+from project.tools.session_state import SessionStore
+from project.tools.prefetch import Prefetcher
+
+DEFAULT_DAYS = 70
+# triggers that redraw the whole lag graph, None is the first call of a page
+LAG_GRAPH_REBUILD = (None, "chamber-select", "date-range")
+# the open and close lines of both gas plots and the slide stats follow the
+# dragged slider, the stats are calculated like PrefixSums.window from the
+# samples in slide-data
+MOVE_LINES_JS = """
+function (drag_value, cycle, slide, ch4, co2) {
+    const no_update = window.dash_clientside.no_update;
+    if (!drag_value || !cycle || !cycle.start) {
+        return [no_update, no_update, no_update];
+    }
+    const start = Date.parse(cycle.start + "Z");
+    const at = (s) => new Date(start + s * 1000).toISOString().slice(0, 19);
+    const close = at(drag_value[0] + cycle.lagtime_s);
+    const open = at(drag_value[1]);
+    const move = (fig) => {
+        if (!fig || !fig.data || fig.data.length <= %(close)d) {
+            return no_update;
+        }
+        const data = fig.data.slice();
+        data[%(open)d] = {...data[%(open)d], x: [open, open]};
+        data[%(close)d] = {...data[%(close)d], x: [close, close]};
+        return {...fig, data: data};
+    };
+
+    const g4 = (v) => (Number.isFinite(v) ? String(Number(v.toPrecision(4))) : "nan");
+    const f4 = (v) => (Number.isFinite(v) ? v.toFixed(4) : "nan");
+    const gas_stats = (gas) => {
+        const lo = drag_value[0] + cycle.lagtime_s;
+        const hi = drag_value[1];
+        const values = slide[gas];
+        let n = 0, ref = null, sx = 0, sy = 0, sxy = 0, sxx = 0, syy = 0;
+        for (let i = 0; i < slide.t.length; i++) {
+            if (values[i] === null || slide.t[i] < lo || slide.t[i] >= hi) {
+                continue;
+            }
+            // relative to the window so that the sums stay well conditioned
+            ref = ref === null ? values[i] : ref;
+            const x = slide.t[i] - lo;
+            const y = values[i] - ref;
+            n += 1; sx += x; sy += y; sxy += x * y; sxx += x * x; syy += y * y;
+        }
+        const cov = n * sxy - sx * sy;
+        const var_x = n * sxx - sx * sx;
+        const var_y = n * syy - sy * sy;
+        const slope = n < 2 || var_x <= 0 ? NaN : cov / var_x;
+        const r = Number.isNaN(slope) || var_y <= 0
+            ? NaN : Math.abs(cov / Math.sqrt(var_x * var_y));
+        const flux = slide.flux[gas] === null ? NaN : slope * slide.flux[gas];
+        return `${gas} slope: ${g4(slope)}/s r: ${f4(r)} flux: ${g4(flux)} mg/m2/h`;
+    };
+    let stats = no_update;
+    if (slide && slide.rev === cycle.rev) {
+        stats = `${drag_value[0]}-${drag_value[1]} s, `
+            + ["CH4", "CO2"].map(gas_stats).join(", ");
+    }
+    return [move(ch4), move(co2), stats];
+}
+""" % {
+    "open": OPEN_TRACE,
+    "close": CLOSE_TRACE,
+}
 
 logger = logging.getLogger("defaultLogger")
 users = temp_users.users
@@ -26,22 +105,24 @@ def ac_plot(flask_app, url):
     app = Dash(__name__, server=flask_app, url_base_pathname=url)
     # app = Dash(__name__, server=flask_app, routes_pathname_prefix=url)
     auth = dash_auth.BasicAuth(app, users)
-    logger = init_logger()
+    init_logger()
     ifdb_read_dict, ifdb_push_dict = load_config()
-    cycles = load_cycles()
-
-    # Generate measurement cycle
-    month = generate_month()
-    all_measurements = generate_measurements(month, cycles)
-    cycle_dict = organize_measurements_by_chamber(all_measurements)
+    met_meas, chamber_heights = load_flux_config()
+    # replays anything spooled while the database was down
+    get_writer(ifdb_push_dict).start()
+    calendar = CycleCalendar(load_cycles())
+    follower = TailFollower(ifdb_read_dict, LICOR_MEAS)
+    sessions = SessionStore()
+    prefetcher = Prefetcher(ifdb_read_dict)
 
-    # Initialize Dash app
-    app.layout = create_layout(all_measurements[0])
+    # Initialize Dash app, cycles are generated when a date range is viewed
+    app.layout = lambda: create_layout(*default_range())
 
     @app.callback(Output("chamber-buttons", "children"), Input("output", "children"))
     def generate_buttons(_):
         options = [
-            {"label": chamber, "value": chamber} for chamber in cycle_dict.keys()
+            {"label": chamber, "value": chamber}
+            for chamber in pd.unique(calendar.chambers)
         ]
         return dcc.Checklist(
             id="chamber-select",
@@ -50,70 +131,249 @@ def ac_plot(flask_app, url):
             inline=True,
         )
 
+    def get_table(start_date, end_date):
+        return calendar.table(*(start_date, end_date) if end_date else default_range())
+
     @app.callback(
-        Output("ch4-plot", "figure"),
-        Output("co2-graph", "figure"),
-        Output("lag-graph", "figure"),
-        Output("measurement-info", "children"),
-        Output("stored-index", "data"),
-        Output("stored-chamber", "data"),
+        Output("tail-ts", "data"),
+        Input("tail-interval", "n_intervals"),
+        State("date-range", "start_date"),
+        State("date-range", "end_date"),
+    )
+    def follow_tail(_, start_date, end_date):
+        try:
+            follower.poll()
+        except Exception as e:
+            logger.warning(f"Following {follower.measurement} failed: {e}")
+            return dash.no_update
+        now = pd.Timestamp.now(tz="UTC")
+        table = get_table(start_date, end_date)
+        todays = table.between(follower.day_start, now)
+        load_into_table(table, todays.idx)
+        ready = follower.ready_cycles([m for m in todays.cycles() if not m.is_ready])
+        todays.sync()
+        save_cycles(ready)
+        last = follower.last_ts.get(follower.measurement)
+        return last.isoformat() if last is not None else None
+
+    def get_selection(selected_chambers, start_date, end_date):
+        table = get_table(start_date, end_date)
+        selected_chambers = selected_chambers or table.chamber_ids()
+        measurements = table.select(selected_chambers, pd.Timestamp.now(tz="UTC"))
+        return table, selected_chambers, measurements
+
+    def current_cycle(cycle, with_data=False):
+        """The CycleSelection and MeasurementCycle of a cycle-rev store."""
+        if not cycle or cycle["index"] is None:
+            return None, None
+        _, _, measurements = get_selection(
+            cycle["chambers"], cycle["start_date"], cycle["end_date"]
+        )
+        if cycle["index"] >= len(measurements):
+            return measurements, None
+        measurement = measurements[cycle["index"]].cycle()
+        # update_cycle may have run in another worker
+        refresh_cycle(measurement)
+        if with_data:
+            load_measurement_data(measurement, ifdb_read_dict)
+        return measurements, measurement
+
+    @app.callback(
+        Output("flux-graph", "figure"),
+        Input("calc-flux", "n_clicks"),
+        State("chamber-select", "value"),
+        State("date-range", "start_date"),
+        State("date-range", "end_date"),
+        prevent_initial_call=True,
+    )
+    def update_flux_graph(_, selected_chambers, start_date, end_date):
+        _, _, measurements = get_selection(selected_chambers, start_date, end_date)
+        df = load_flux_table(
+            measurements.frame(), ifdb_read_dict, met_meas, chamber_heights
+        )
+        return mk_flux_plot(df)
+
+    @app.callback(
+        Output("slide-stats", "children"),
+        Output("slide-data", "data"),
+        Input("cycle-rev", "data"),
+    )
+    def update_slide_stats(cycle):
+        if not cycle:
+            return dash.no_update, dash.no_update
+        _, measurement = current_cycle(cycle, with_data=True)
+        if measurement is None or measurement.data is None:
+            return "", None
+        met = cycle_met(measurement, ifdb_read_dict, met_meas)
+        height = chamber_heights.get(str(measurement.id), np.nan)
+        stats = generate_slide_stats(
+            measurement,
+            measurement.close_offset,
+            measurement.open_offset,
+            met,
+            height,
+        )
+        return stats, generate_slide_data(measurement, met, height, cycle["rev"])
+
+    # moves the lines and updates the stats while the slider is dragged, the
+    # server only gets the final offsets through the slider value on mouseup
+    app.clientside_callback(
+        MOVE_LINES_JS,
+        Output("ch4-plot", "figure", allow_duplicate=True),
+        Output("co2-graph", "figure", allow_duplicate=True),
+        Output("slide-stats", "children", allow_duplicate=True),
+        Input("ch4-slide", "drag_value"),
+        State("cycle-rev", "data"),
+        State("slide-data", "data"),
+        State("ch4-plot", "figure"),
+        State("co2-graph", "figure"),
+        prevent_initial_call=True,
+    )
+
+    @app.callback(
+        Output("cycle-rev", "data"),
         Output("ch4-slide", "value"),
-        State("lag-graph", "relayoutData"),
-        State("lag-graph", "figure"),
         Input("prev-button", "n_clicks"),
         Input("next-button", "n_clicks"),
+        Input("lag-graph", "clickData"),
+        Input("reset-index", "n_clicks"),
+        Input("chamber-select", "value"),
+        Input("date-range", "start_date"),
+        Input("date-range", "end_date"),
         Input("find-lag", "n_clicks"),
         Input("del-lagtime", "n_clicks"),
-        Input("push-all", "n_clicks"),
-        Input("push-lag", "n_clicks"),
-        Input("chamber-select", "value"),
-        State("stored-index", "data"),
-        State("stored-chamber", "data"),
-        [Input("lag-graph", "clickData")],
-        Input("ch4-slide", "value"),
-        Input("co2-slide", "value"),
+        Input("max-r", "n_clicks"),
         Input("mark-invalid", "n_clicks"),
         Input("mark-valid", "n_clicks"),
         Input("reset-cycle", "n_clicks"),
-        Input("reset-index", "n_clicks"),
-        Input("max-r", "n_clicks"),
+        Input("ch4-slide", "value"),
+        State("session-id", "data"),
     )
-    def update_graph(*args):
-        triggered_id, index, measurements, measurement, selected_chambers = (
-            handle_triggers(args, cycle_dict, logger)
+    def update_cycle(*args):
+        """
+        Select the cycle and apply the action that was clicked. The figures
+        and the info text are updated by their own callbacks when cycle-rev
+        changes, they find the cycle from it.
+        """
+        (
+            prev_clicks,
+            next_clicks,
+            get_point,
+            reset_index,
+            selected_chambers,
+            start_date,
+            end_date,
+            find_max,
+            del_lagtime,
+            max_r,
+            mark_invalid,
+            mark_valid,
+            reset_cycle,
+            ch4_slider_values,
+            session_id,
+        ) = args
+        triggered_id = ctx.triggered_id if ctx.triggered else None
+        table, _, measurements = get_selection(
+            selected_chambers, start_date, end_date
         )
+        cycle = {
+            "index": None,
+            "chambers": selected_chambers,
+            "start_date": start_date,
+            "end_date": end_date,
+            # None is the first call of a page, the browser has no figures yet
+            "reload": triggered_id is None,
+            "rebuild_lag": triggered_id in LAG_GRAPH_REBUILD,
+        }
+        with sessions.session(session_id) as state:
+            state["rev"] = cycle["rev"] = state.get("rev", 0) + 1
+            if not measurements:
+                return cycle, dash.no_update
+            load_into_table(table, measurements.idx)
+            index = select_index(
+                triggered_id, state.get("index", 0), measurements, get_point, calendar
+            )
+            measurement = measurements[index].cycle()
+
+            # another worker may have changed the cycle since it was loaded
+            refresh_cycle(measurement)
+            slider_vals = update_slider(ch4_slider_values, measurement, triggered_id)
+            load_measurement_data(measurement, ifdb_read_dict)
+            execute_actions(triggered_id, measurement)
+            table.sync(measurements.idx[index])
+            save_cycles([measurement])
+            state["index"] = index
+        # the next cycles are likely to be looked at next
+        prefetcher.prefetch(measurements, index)
+        cycle["index"] = index
+        # for MOVE_LINES_JS, plotly shows the wall time of the timestamps
+        cycle["start"] = measurement.start.strftime("%Y-%m-%dT%H:%M:%S")
+        cycle["lagtime_s"] = float(measurement.lagtime_s)
+        return cycle, slider_vals
 
-        if not measurements:
-            return no_data_response(selected_chambers)
+    @app.callback(
+        Output("ch4-plot", "figure"),
+        Output("co2-graph", "figure"),
+        Input("cycle-rev", "data"),
+        State("session-id", "data"),
+    )
+    def update_gas_plots(cycle, session_id):
+        if not cycle:
+            return dash.no_update, dash.no_update
+        _, measurement = current_cycle(cycle, with_data=True)
+        return create_ch4_co2_plots(measurement, cycle, sessions, session_id)
 
-        slider_vals = update_slider(args[12], measurement, triggered_id)
-        load_measurement_data(measurement, ifdb_read_dict)
+    @app.callback(
+        Output("measurement-info", "children"),
+        Input("cycle-rev", "data"),
+    )
+    def update_measurement_info(cycle):
+        if not cycle:
+            return dash.no_update
+        measurements, measurement = current_cycle(cycle)
+        if measurement is None:
+            return "No data available"
+        return generate_measurement_info(measurement, cycle["index"], measurements)
 
-        execute_actions(
-            triggered_id, measurement, measurements, ifdb_read_dict, ifdb_push_dict
+    @app.callback(
+        Output("lag-graph", "figure"),
+        Input("cycle-rev", "data"),
+        Input("push-all", "n_clicks"),
+        Input("push-lag", "n_clicks"),
+        State("lag-graph", "relayoutData"),
+        State("session-id", "data"),
+    )
+    def update_lag_graph(cycle, _, __, lag_state, session_id):
+        if not cycle:
+            return dash.no_update
+        triggered_id = ctx.triggered_id if ctx.triggered else None
+        measurements, measurement = current_cycle(cycle)
+        if measurement is None:
+            sessions.update(session_id, lag_highlighter=None)
+            return Figure()
+        if triggered_id == "push-all":
+            push_all_data(ifdb_read_dict, ifdb_push_dict, measurements)
+        if triggered_id == "push-lag":
+            push_one_lag(ifdb_push_dict, measurement)
+        rebuild = cycle["rebuild_lag"]
+        if triggered_id in ("push-all", "push-lag"):
+            # the graph reads the pushed lag times back, uncached, so they
+            # have to be written before it is redrawn
+            get_writer(ifdb_push_dict).flush()
+            rebuild = True
+        _, chambers, _ = get_selection(
+            cycle["chambers"], cycle["start_date"], cycle["end_date"]
         )
-
-        fig_ch4, fig_co2 = create_ch4_co2_plots(measurement)
-        lag_graph = create_lag_graph(
+        return create_lag_graph(
             measurements,
             measurement,
             ifdb_push_dict,
-            selected_chambers,
-            index,
-            triggered_id,
-        )
-        lag_graph = apply_lag_graph_zoom(lag_graph, args[0])
-
-        measurement_info = generate_measurement_info(measurement, index, measurements)
-
-        return (
-            fig_ch4,
-            fig_co2,
-            lag_graph,
-            measurement_info,
-            index,
-            selected_chambers,
-            slider_vals,
+            chambers,
+            cycle["index"],
+            rebuild,
+            sessions,
+            session_id,
+            lag_state,
         )
 
     return app
@@ -125,90 +385,51 @@ def load_config():
     return config["ifdb_read_dict"], config["ifdb_push_dict"]
 
 
+def load_flux_config():
+    with open("project/config.json", "r") as f:
+        config = json.load(f)
+    return config.get("met_meas_dict", MET_MEAS), config.get("chamber_heights", {})
+
+
 def load_cycles():
     with open("project/cycle.json", "r") as f:
         return json.load(f)["CYCLE"]
 
 
-def generate_month():
-    today = datetime.today()
-    return [(today - timedelta(days=i)).date() for i in range(70)][::-1]
+def default_range():
+    today = datetime.today().date()
+    return today - timedelta(days=DEFAULT_DAYS - 1), today
 
 
-def generate_measurements(month, cycles):
-    all_measurements = []
-    for day in month:
-        for cycle in cycles:
-            if pd.Timestamp(f"{day} {cycle.get('START')}") > datetime.now():
-                continue
-            s, c, o, e = (
-                pd.Timestamp(f"{day} {cycle.get(time)}")
-                for time in ["START", "CLOSE", "OPEN", "END"]
-            )
-            all_measurements.append(MeasurementCycle(cycle["CHAMBER"], s, c, o, e))
-    return all_measurements
-
-
-def organize_measurements_by_chamber(all_measurements):
-    cycle_dict = {}
-    for mes in all_measurements:
-        cycle_dict.setdefault(mes.id, []).append(mes)
-    return cycle_dict
-
-
-def handle_triggers(args, cycle_dict, logger):
-    logger.debug("Running.")
-    (
-        lag_state,
-        _,
-        prev_clicks,
-        next_clicks,
-        find_max,
-        del_lagtime,
-        push_all,
-        push_one,
-        selected_chambers,
-        index,
-        chamber,
-        get_point,
-        ch4_slider_values,
-        co2_slider_values,
-        mark_invalid,
-        mark_valid,
-        reset_cycle,
-        reset_index,
-        max_r,
-    ) = args
-    triggered_id = ctx.triggered_id if ctx.triggered else None
-    selected_chambers = selected_chambers or list(cycle_dict.keys())
-
-    measurements = sorted(
-        [
-            measurement
-            for chamber in selected_chambers
-            for measurement in cycle_dict.get(chamber, [])
-        ],
-        key=lambda x: x.open,
-    )
-
+def select_index(triggered_id, index, measurements, get_point, calendar):
     if triggered_id == "prev-button":
         index = decrement_index(index, measurements)
     elif triggered_id == "next-button":
         index = increment_index(index, measurements)
     elif triggered_id == "lag-graph" and get_point:
         logger.debug(get_point)
-        index = get_point.get("points")[0].get("customdata")[2]
+        index = clicked_index(get_point, measurements, calendar, index)
     elif triggered_id == "reset-index":
         index = 0
-    elif triggered_id == "chamber-select":
+    elif triggered_id in ("chamber-select", "date-range"):
         index = 0
-
-    measurement = measurements[index] if measurements else None
-    return triggered_id, index, measurements, measurement, selected_chambers
+    return index
 
 
-def no_data_response(selected_chambers):
-    return Figure(), Figure(), Figure(), "No data available", 0, selected_chambers
+def clicked_index(get_point, measurements, calendar, index):
+    """
+    Index of the cycle of a clicked lag graph point, the flux points are
+    drawn at their UTC wall time. Keeps index if the cycle isn't selected.
+    """
+    located = calendar.locate(get_point.get("points")[0].get("x"))
+    if located is None:
+        return index
+    _, start = located
+    row = measurements.table.find(start)
+    if row < 0 or measurements.table.start[row] != start.value:
+        return index
+    position = np.flatnonzero(measurements.idx == row)
+    return int(position[0]) if len(position) else index
 
 
 def update_slider(ch4_slider_values, measurement, triggered_id):
@@ -227,23 +448,18 @@ def update_slider(ch4_slider_values, measurement, triggered_id):
 
 
 def load_measurement_data(measurement, ifdb_read_dict):
-    if measurement.data is None and measurement.is_valid:
+    # cycles that failed the quality rules are still drawn
+    if measurement.data is None and not measurement.no_data_in_db:
         measurement.get_data(ifdb_read_dict)
 
 
-def execute_actions(
-    triggered_id, measurement, measurements, ifdb_read_dict, ifdb_push_dict
-):
+def execute_actions(triggered_id, measurement):
     if triggered_id == "find-lag":
         measurement.get_max()
     if triggered_id == "del-lagtime":
         measurement.del_lagtime()
     if triggered_id == "max-r":
         measurement.get_max_r()
-    if triggered_id == "push-all":
-        push_all_data(ifdb_read_dict, ifdb_push_dict, measurements)
-    if triggered_id == "push-lag":
-        push_one_lag(ifdb_push_dict, measurement)
     if triggered_id == "mark-invalid":
         measurement.manual_valid = False
     if triggered_id == "mark-valid":
@@ -252,61 +468,74 @@ def execute_actions(
         measurement.lagtimes_s = 0
 
 
-def create_ch4_co2_plots(measurement):
-    fig_ch4, fig_co2 = Figure(), Figure()
-    if measurement.data is not None:
+def gas_overlays(measurement):
+    """Everything apply_gas_overlays draws, to tell if the plots need updating."""
+    return (
+        measurement.close_offset,
+        measurement.open_offset,
+        measurement.lagtime_s,
+        measurement.ch4_r_offset,
+        measurement.co2_r_offset,
+        measurement.is_valid,
+        measurement.manual_valid,
+    )
+
+
+def create_ch4_co2_plots(measurement, cycle, sessions, session_id):
+    """
+    Full figures when another cycle is shown, patches that only move the
+    overlays when the shown one changed and no update if nothing did. What
+    the browser has is kept in the session state.
+    """
+    if measurement is None or measurement.data is None:
+        sessions.update(session_id, shown=None)
+        return Figure(), Figure()
+    state = sessions.get(session_id)
+    shown = (measurement.id, measurement.start.value)
+    overlays = gas_overlays(measurement)
+    if cycle["reload"] or state.get("shown") != shown:
         fig_ch4 = mk_gas_plot(measurement, "CH4")
         fig_co2 = mk_gas_plot(measurement, "CO2", color_key="green")
+    elif state.get("overlays") == overlays:
+        return dash.no_update, dash.no_update
+    else:
+        fig_ch4 = patch_gas_plot(measurement, "CH4")
+        fig_co2 = patch_gas_plot(measurement, "CO2")
+    sessions.update(session_id, shown=shown, overlays=overlays)
     return fig_ch4, fig_co2
 
 
 def create_lag_graph(
-    measurements, measurementos, ifdb_push_dict, selected_chambers, index, triggered_id
+    measurements,
+    measurementos,
+    ifdb_push_dict,
+    selected_chambers,
+    index,
+    rebuild,
+    sessions,
+    session_id,
+    lag_state_dict,
 ):
-    global lag_graph_dir
-    print(triggered_id)
-    if lag_graph_dir is False or triggered_id == "chamber-select":
-        lag_graph = mk_lag_plot(
-            measurements, measurementos, ifdb_push_dict, selected_chambers, index
-        )
-    elif lag_graph_dir is not False:
-        logger.debug("Recreating highlight")
-        highlighter = apply_lag_highlighter(measurementos)
-        updated_fig_data = lag_graph_dir["data"]
-        # logger.debug(updated_fig_data[0])
-        traces = list(updated_fig_data[:-1])
-        highlighter = [highlighter]
-        return go.Figure(traces + highlighter, lag_graph_dir.layout)
-    lag_graph_dir = lag_graph
-    return lag_graph
-
-
-def apply_lag_highlighter(current_measurement):
-    logger.debug("Creating highlighter")
-    data2 = [
-        (
-            current_measurement.close,
-            current_measurement.lagtime_s,
-            current_measurement.id,
-        )
-    ]
-    df2 = pd.DataFrame(data2, columns=["close", "lagtime", "id"]).set_index("close")
-    logger.debug(df2)
-    highlighter = go.Scatter(
-        x=df2.index,
-        y=df2["lagtime"],
-        mode="markers",
-        marker=dict(
-            symbol="circle",
-            size=15,
-            color="rgba(255,0,0,0)",
-            line=dict(color="rgba(255,0,0,1)", width=2),
-        ),
-        name="Current",
-        hoverinfo="none",
-        showlegend=True,
+    state = sessions.get(session_id)
+    highlighter = state.get("lag_highlighter")
+    highlight = (measurementos.close, measurementos.lagtime_s)
+    if highlighter is not None and not rebuild:
+        if state.get("lag_highlight") == highlight:
+            return dash.no_update
+        logger.debug("Moving highlight")
+        sessions.update(session_id, lag_highlight=highlight)
+        return patch_lag_highlighter(measurementos, highlighter)
+
+    lag_graph = mk_lag_plot(
+        measurements, measurementos, ifdb_push_dict, selected_chambers, index
     )
-    return highlighter
+    # the highlighter is the last trace, none if there was nothing to plot
+    sessions.update(
+        session_id,
+        lag_highlighter=len(lag_graph.data) - 1 if lag_graph.data else None,
+        lag_highlight=highlight,
+    )
+    return apply_lag_graph_zoom(lag_graph, lag_state_dict)
 
 
 def apply_lag_graph_zoom(lag_graph, lag_state_dict):
@@ -333,15 +562,16 @@ def lag_graph_zoom(lag_state_dict):
 
 def push_all_data(read_dict, push_dict, measurements):
     tag_cols = ["chamber"]
-    with init_client(read_dict) as client:
-        for m in measurements:
-            m.just_get_data(read_dict, client)
-    data = [(m.close, m.lagtime_s, int(m.id), int(m.id)) for m in measurements]
+    client = get_client(read_dict)
+    cycles = measurements.cycles()
+    bulk_get_data(cycles, read_dict, client)
+    measurements.sync()
+    save_cycles(cycles)
+    data = [(m.close, m.lagtime_s, int(m.id), int(m.id)) for m in cycles]
     df = pd.DataFrame(data, columns=["close", "lagtime", "id", "chamber"]).set_index(
         "close"
     )
-    with init_client(push_dict) as client:
-        ifdb_push(df, client, push_dict, tag_cols)
+    ifdb_push(df, push_dict, tag_cols)
 
 
 def push_one_lag(ifdb_dict, measurement):
@@ -358,8 +588,7 @@ def push_one_lag(ifdb_dict, measurement):
         "close"
     )
     logger.debug(data)
-    with init_client(ifdb_dict) as client:
-        ifdb_push(df, client, ifdb_dict, tag_cols)
+    ifdb_push(df, ifdb_dict, tag_cols)
 
 
 def decrement_index(index, measurements):
@@ -370,6 +599,43 @@ def increment_index(index, measurements):
     return (index + 1) % len(measurements)
 
 
+def generate_slide_stats(measurement, close, open, met, height):
+    stats = []
+    for gas in ["CH4", "CO2"]:
+        n, slope, r = measurement.window_stats(gas, close, open)
+        flux = float(
+            calculate_gas_fluxes(
+                slope, gas, met["air_temperature"], met["air_pressure"], height
+            )
+        )
+        stats.append(f"{gas} slope: {slope:.4g}/s r: {r:.4f} flux: {flux:.4g} mg/m2/h")
+    return f"{close}-{open} s, " + ", ".join(stats)
+
+
+def generate_slide_data(measurement, met, height, rev):
+    """
+    The samples of the cycle in seconds from start and the flux of a slope
+    of 1/s, for MOVE_LINES_JS to show the slide stats while dragging.
+    """
+    data = measurement.data
+    slide = {
+        "rev": rev,
+        "t": np.round((data.index.asi8 - measurement.start.value) / 1e9, 3).tolist(),
+        "flux": {},
+    }
+    for gas in ["CH4", "CO2"]:
+        values = data[gas].to_numpy(dtype=float)
+        slide[gas] = [None if np.isnan(v) else v for v in values.tolist()]
+        # the flux is linear in the slope
+        flux = float(
+            calculate_gas_fluxes(
+                1.0, gas, met["air_temperature"], met["air_pressure"], height
+            )
+        )
+        slide["flux"][gas] = None if np.isnan(flux) else flux
+    return slide
+
+
 def generate_measurement_info(measurement, index, measurements):
     valid_str = "Valid: True" if measurement.is_valid else "Valid: False"
     return f"Measurement {index + 1}/{len(measurements)} - Date: {measurement.start.date()} {valid_str}"
@@ -4,6 +4,7 @@ import time
 import uuid
 from project.log_layout import create_layout
 from project.push_point import ifdb_push
+from project.tools.ifdb_writer import get_writer
 from datetime import datetime as dt
 from dash import Dash, dcc, ctx, html, Input, Output, State
 import dash_auth
@@ -32,6 +33,8 @@ def maintenance_log(flask_app, url):
     with open("project/maintenance_log_config.json", "r") as f:
         config = json.load(f)
         ifdb_dict = config["CONFIG"]["INFLUXDB"]
+    # replays log messages spooled while the database was down
+    get_writer(ifdb_dict).start()
 
     # NOTE: import layout from file
     app.layout = create_layout()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import atexit
+import logging
+import os
+import threading
+
+import influxdb_client as ifdb
+from influxdb_client.client.write_api import SYNCHRONOUS
+
+logger = logging.getLogger("defaultLogger")
+
+# connections kept alive per client, gunicorn sync workers only need a few but
+# the dash callbacks can run in threads
+POOL_MAXSIZE = int(os.getenv("IFDB_POOL_MAXSIZE", 10))
+
+_lock = threading.Lock()
+_clients = {}
+_write_apis = {}
+
+
+def client_key(ifdb_dict):
+    return (
+        ifdb_dict.get("url"),
+        ifdb_dict.get("organization"),
+        ifdb_dict.get("token"),
+    )
+
+
+def get_client(ifdb_dict):
+    """
+    Return the pooled InfluxDBClient for the url, org and token in ifdb_dict.
+
+    The client is created on first use and kept open for the life of the
+    process, so repeated queries reuse the same keep-alive connections instead
+    of doing a new handshake every time. Don't close the returned client, use
+    close_clients() for that.
+
+    args:
+    ---
+    ifdb_dict -- dict
+        influxdb config with url, organization, token and timeout
+
+    returns:
+    ---
+    influxdb_client.InfluxDBClient
+    """
+    key = client_key(ifdb_dict)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            logger.debug(f"Creating pooled client for {key[0]}.")
+            client = ifdb.InfluxDBClient(
+                url=key[0],
+                org=key[1],
+                token=key[2],
+                timeout=ifdb_dict.get("timeout"),
+                connection_pool_maxsize=POOL_MAXSIZE,
+            )
+            _clients[key] = client
+    return client
+
+
+def get_query_api(ifdb_dict):
+    return get_client(ifdb_dict).query_api()
+
+
+def get_write_api(ifdb_dict):
+    """Return the synchronous write api of the pooled client, created once."""
+    key = client_key(ifdb_dict)
+    write_api = _write_apis.get(key)
+    if write_api is not None:
+        return write_api
+    client = get_client(ifdb_dict)
+    with _lock:
+        write_api = _write_apis.get(key)
+        if write_api is None:
+            write_api = client.write_api(write_options=SYNCHRONOUS)
+            _write_apis[key] = write_api
+    return write_api
+
+
+def close_clients():
+    """Close every pooled client, used on shutdown."""
+    with _lock:
+        for write_api in _write_apis.values():
+            try:
+                write_api.close()
+            except Exception as e:
+                logger.debug(e)
+        for client in _clients.values():
+            try:
+                client.close()
+            except Exception as e:
+                logger.debug(e)
+        _write_apis.clear()
+        _clients.clear()
+
+
+def _reset_after_fork():
+    # the sockets belong to the parent process, the child must open its own.
+    # The lock might have been held by another thread at fork time.
+    global _lock
+    _lock = threading.Lock()
+    _write_apis.clear()
+    _clients.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(close_clients)
@@ -1,4 +1,5 @@
-from project.tools.influxdb_funcs import init_client, just_read, read_ifdb
+from project.tools.influxdb_funcs import just_read, read_ifdb
+from dash import Patch
 from plotly.graph_objs import Figure
 import plotly.graph_objs as go
 import plotly.express as px
@@ -8,23 +9,27 @@ import logging
 logger = logging.getLogger("defaultLogger")
 
 
+INVALID_BG = "rgba(255, 223, 223, 1)"
+INVALID_WATERMARK = dict(
+    name="draft watermark",
+    text="INVALID",
+    textangle=0,
+    opacity=0.4,
+    font=dict(color="black", size=50),
+    xref="paper",
+    yref="paper",
+    x=0.5,
+    y=0.5,
+    showarrow=False,
+)
+# positions of the overlay traces in the gas plots
+OPEN_TRACE, CLOSE_TRACE, LAG_TRACE = 1, 2, 3
+
+
 def mk_gas_plot(measurement, gas, color_key="blue"):
     logger.debug(f"Running for {gas}.")
     color_dict = {"blue": "rgb(14,168,213,0)", "green": "rgba(27,187,11,1)"}
 
-    close = measurement.close
-    open = measurement.open
-    if gas == "CH4":
-        r_s = measurement.start + pd.Timedelta(seconds=measurement.ch4_r_offset)
-        r_e = r_s + pd.Timedelta(seconds=180)
-        r_pos = r_e - pd.Timedelta(seconds=90)
-        r = measurement.ch4_r
-    if gas == "CO2":
-        r_s = measurement.start + pd.Timedelta(seconds=measurement.co2_r_offset)
-        r_e = r_s + pd.Timedelta(seconds=180)
-        r_pos = r_e - pd.Timedelta(seconds=90)
-        r = measurement.co2_r
-
     trace_data = go.Scatter(
         x=measurement.data.index,
         y=measurement.data[gas],
@@ -37,43 +42,27 @@ def mk_gas_plot(measurement, gas, color_key="blue"):
             line=dict(color=color_dict.get(color_key), width=1),
         ),
     )
+    # the overlay coordinates are filled in by apply_gas_overlays
+    open_line = go.Scatter(
+        mode="lines",
+        line=dict(color="green", dash="dash"),
+        name="Open",
+    )
     close_line = go.Scatter(
-        x=[close, close],
-        y=[measurement.data[gas].min(), measurement.data[gas].max()],
         mode="lines",
         line=dict(color="red", dash="dash"),
         name="Close",
     )
-    open_line = go.Scatter(
-        x=[open, open],
-        y=[measurement.data[gas].min(), measurement.data[gas].max()],
+    lag_line = go.Scatter(
         mode="lines",
-        line=dict(color="green", dash="dash"),
-        name="Open",
-    )
-
-    lag_line = (
-        go.Scatter(
-            x=[measurement.lagtime_index, measurement.lagtime_index],
-            y=[measurement.data[gas].min(), measurement.data[gas].max()],
-            mode="lines",
-            line=dict(color="purple", dash="dashdot", width=1),
-            name="lagtime",
-        )
-        if measurement.lagtime_index
-        else None
+        line=dict(color="purple", dash="dashdot", width=1),
+        name="lagtime",
     )
 
     layout = go.Layout(
         # width=1000,
         # height=300,
-        title={
-            "text": f"Chamber {measurement.id} {gas} Measurement {close}",
-            # "x": 0.33,  # Horizontal position of the title (0 - left, 0.5 - center, 1 - right)
-            # "y": 0.82,  # Vertical position of the title, with 1 being the top
-            # "xanchor": "center",  # Anchoring the title horizontally
-            # "yanchor": "top",  # Anchoring the title vertically
-        },
+        title={"text": ""},
         margin=dict(
             l=10,
             r=10,
@@ -83,49 +72,50 @@ def mk_gas_plot(measurement, gas, color_key="blue"):
         xaxis=dict(type="date"),
     )
 
-    fig = go.Figure(
-        data=[trace_data, open_line, close_line, lag_line]
-        if lag_line
-        else [trace_data, open_line, close_line],
-        layout=layout,
-    )
-    if measurement.is_valid is False or measurement.manual_valid is False:
-        fig.update_layout(
-            {
-                "plot_bgcolor": "rgba(255, 223, 223, 1)",
-            },
-            # template=draft_template,
-            annotations=[
-                dict(
-                    name="draft watermark",
-                    text="INVALID",
-                    textangle=0,
-                    opacity=0.4,
-                    font=dict(color="black", size=50),
-                    xref="paper",
-                    yref="paper",
-                    x=0.5,
-                    y=0.5,
-                    showarrow=False,
-                )
-            ],
-        )
+    fig = go.Figure(data=[trace_data, open_line, close_line, lag_line], layout=layout)
+    return apply_gas_overlays(fig, measurement, gas)
+
+
+def patch_gas_plot(measurement, gas):
+    """Patch that moves the overlays of a plot made by mk_gas_plot."""
+    return apply_gas_overlays(Patch(), measurement, gas)
+
+
+def apply_gas_overlays(fig, measurement, gas):
+    """
+    Set the close, open and lag lines, the max r window and the validity
+    shading, fig is a go.Figure from mk_gas_plot or a dash.Patch of one.
+    """
+    close = measurement.close
+    open = measurement.open
+    lag = measurement.lagtime_index
+    y = [measurement.data[gas].min(), measurement.data[gas].max()]
+    r_offset = measurement.ch4_r_offset if gas == "CH4" else measurement.co2_r_offset
+    r_s = measurement.start + pd.Timedelta(seconds=r_offset)
+    r_e = r_s + pd.Timedelta(seconds=180)
+
+    for trace, x in ((OPEN_TRACE, open), (CLOSE_TRACE, close), (LAG_TRACE, lag)):
+        fig["data"][trace]["x"] = [x, x]
+        fig["data"][trace]["y"] = y
+    title = f"Chamber {measurement.id} {gas} Measurement {close}"
+    fig["layout"]["title"]["text"] = title
 
-    if measurement.is_valid is True or measurement.manual_valid is True:
-        fig.add_shape(
+    invalid = measurement.is_valid is False or measurement.manual_valid is False
+    fig["layout"]["plot_bgcolor"] = INVALID_BG if invalid else None
+    fig["layout"]["annotations"] = [INVALID_WATERMARK] if invalid else []
+    fig["layout"]["shapes"] = [
+        dict(
             type="rect",
             x0=r_s,
             x1=r_e,
-            y0=min(measurement.data[gas]),
-            y1=max(measurement.data[gas]),
+            y0=y[0],
+            y1=y[1],
             fillcolor="grey",
             opacity=0.3,
             line_width=0,
+            visible=measurement.is_valid is True or measurement.manual_valid is True,
         )
-        # fig.add_annotation(
-        #     text=round(r, 4), x=r_e, y=min(measurement.data[gas]), showarrow=False
-        # )
-
+    ]
     return fig
 
 
@@ -149,7 +139,10 @@ def mk_lag_plot(measurements, current_measurement, ifdb_dict, selected_chambers,
     q_arr = {"tag": tag, "arr": arr_str}
 
     logger.debug("Querying.")
-    df = read_ifdb(ifdb_dict, meas_dict, start_ts=start_ts, stop_ts=end_ts, arr=q_arr)
+    # not cached, the graph is redrawn right after lag times are pushed
+    df = read_ifdb(
+        ifdb_dict, meas_dict, start_ts=start_ts, stop_ts=end_ts, arr=q_arr, cache=False
+    )
     if df is None:
         return go.Figure()
     df.set_index("datetime", inplace=True)
@@ -227,6 +220,47 @@ def mk_lag_plot(measurements, current_measurement, ifdb_dict, selected_chambers,
     return fig
 
 
+def mk_flux_plot(df, gas="CH4"):
+    logger.debug("Creating flux graph.")
+    if df is None or df.empty:
+        return go.Figure()
+    column = f"{gas.lower()}_flux"
+    color_map = create_color_mapping(df, "chamber")
+
+    traces = []
+    for chamber, color in color_map.items():
+        filtered_df = df[df["chamber"] == chamber]
+        traces.append(
+            go.Scatter(
+                x=filtered_df["close"],
+                y=filtered_df[column],
+                mode="markers",
+                name=f"{chamber}",
+                marker=dict(color=color, size=5),
+            )
+        )
+
+    layout = go.Layout(
+        hovermode="closest",
+        title={"text": f"{gas} flux mg/m2/h"},
+        margin=dict(l=10, r=10, t=30, b=10),
+        xaxis=dict(type="date"),
+        legend=dict(font=dict(size=13), orientation="h", tracegroupgap=3),
+    )
+    fig = go.Figure(data=traces, layout=layout)
+    fig.add_hline(y=0, line_dash="dash", line_color="blue", line_width=1)
+
+    return fig
+
+
+def patch_lag_highlighter(current_measurement, trace):
+    """Patch that moves the "Current" marker, trace is its index."""
+    patched = Patch()
+    patched["data"][trace]["x"] = [current_measurement.close]
+    patched["data"][trace]["y"] = [current_measurement.lagtime_s]
+    return patched
+
+
 fixed_color_mapping = {}
 color_list = px.colors.qualitative.Plotly + px.colors.qualitative.D3
 
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from project.tools.cycle_table import CycleTable, NS
+from project.tools.time_funcs import time_to_numeric
+
+logger = logging.getLogger("defaultLogger")
+
+DAY_S = 24 * 3600
+TABLE_CACHE_SIZE = 4
+NAT = np.iinfo(np.int64).min
+
+
+class CycleCalendar:
+    """
+    Derives measurement cycles from the cycle.json schedule on demand.
+
+    The schedule is given as local wall clock times that repeat every day.
+    Cycles that fall into the hour skipped when DST starts don't exist, and
+    cycles in the hour repeated when DST ends happen twice, once in summer
+    time and once in winter time.
+
+    args:
+    ---
+    schedule -- list of dicts
+        the CYCLE list of cycle.json
+    tz -- str
+        timezone of the schedule
+    """
+
+    def __init__(self, schedule, tz="Europe/Helsinki"):
+        self.tz = tz
+        self.chambers = np.array([c["CHAMBER"] for c in schedule])
+        self.secs = {
+            key: time_to_numeric([c.get(key) for c in schedule]).astype(np.int64)
+            for key in ["START", "CLOSE", "OPEN", "END"]
+        }
+        # schedule row running at each second of the day, -1 if none
+        self.slots = np.full(DAY_S, -1, dtype=np.int64)
+        for i, (start, end) in enumerate(zip(self.secs["START"], self.secs["END"])):
+            self.slots[start : end + 1] = i
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    def table(self, first_day, last_day):
+        """
+        CycleTable of every cycle from first_day to last_day, both included.
+        The last few tables are kept so that switching back is free.
+        """
+        first_day = pd.Timestamp(first_day).date()
+        last_day = pd.Timestamp(last_day).date()
+        key = (first_day, last_day)
+        with self._lock:
+            table = self._tables.get(key)
+            if table is not None:
+                self._tables.move_to_end(key)
+                return table
+        table = self.build(pd.date_range(first_day, last_day, freq="D"))
+        with self._lock:
+            table = self._tables.setdefault(key, table)
+            while len(self._tables) > TABLE_CACHE_SIZE:
+                self._tables.popitem(last=False)
+        logger.debug(f"Built {len(table)} cycles for {first_day} - {last_day}.")
+        return table
+
+    def build(self, days):
+        """Vectorized CycleTable for the given days."""
+        day64 = np.asarray(days, dtype="datetime64[D]").astype("datetime64[ns]")
+        chambers = np.tile(self.chambers, len(day64))
+        local = {
+            key: (day64[:, None] + (secs * NS).astype("timedelta64[ns]")).ravel()
+            for key, secs in self.secs.items()
+        }
+        summer = {key: self.localize(t, True) for key, t in local.items()}
+        winter = {key: self.localize(t, False) for key, t in local.items()}
+
+        # the same for both unless the time is ambiguous, NaT if it doesn't
+        # exist
+        exists = np.all([summer[k] != NAT for k in summer], axis=0)
+        repeated = exists & np.any([summer[k] != winter[k] for k in summer], axis=0)
+        times = {
+            k: np.concatenate((summer[k][exists], winter[k][repeated])) for k in summer
+        }
+        chambers = np.concatenate((chambers[exists], chambers[repeated]))
+        order = np.argsort(times["START"], kind="stable")
+        return CycleTable(
+            chambers[order],
+            times["START"][order],
+            times["CLOSE"][order],
+            times["OPEN"][order],
+            times["END"][order],
+        )
+
+    def localize(self, local, ambiguous):
+        """Local naive datetime64 array to int64 ns UTC, NaT for missing."""
+        index = pd.DatetimeIndex(local).tz_localize(
+            self.tz, ambiguous=np.full(len(local), ambiguous), nonexistent="NaT"
+        )
+        return index.asi8
+
+    def locate(self, ts):
+        """
+        The cycle running at ts.
+
+        args:
+        ---
+        ts -- pd.Timestamp
+            naive timestamps are taken as UTC
+
+        returns:
+        ---
+        (chamber, start) where start is a UTC pd.Timestamp, None if no cycle
+        is scheduled at that time
+        """
+        ts = pd.Timestamp(ts)
+        if ts.tzinfo is None:
+            ts = ts.tz_localize("UTC")
+        local = ts.tz_convert(self.tz)
+        sec = local.hour * 3600 + local.minute * 60 + local.second
+        row = self.slots[sec]
+        if row < 0:
+            return None
+        # in UTC, the local wall time is ambiguous in the repeated DST hour
+        start = ts.floor("s") - pd.Timedelta(seconds=sec - self.secs["START"][row])
+        return self.chambers[row], start.tz_convert("UTC")
+
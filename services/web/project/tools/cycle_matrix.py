@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+import logging
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from project.tools.gas_funcs import LAG_SHIFTS_S, pick_lag
+from project.tools.quality import evaluate_rules, failed_rules
+
+logger = logging.getLogger("defaultLogger")
+
+CYCLE_LENGTH_S = 900
+GASES = ["CH4", "CO2", "DIAG"]
+
+
+def prefix_sum(a):
+    """Cumulative sum along the rows with a leading zero column."""
+    return np.concatenate((np.zeros((a.shape[0], 1)), np.cumsum(a, axis=1)), axis=1)
+
+
+class CycleMatrix:
+    """
+    Many measurement cycles aligned on a 1 Hz grid relative to their start.
+
+    Each column of the data ends up in a (n_cycles x length) float array,
+    missing seconds are nan and mask tells which seconds have data. All the
+    calculations work on every cycle at once.
+
+    args:
+    ---
+    starts -- np.array
+        int64 ns start of each cycle
+    values -- dict
+        column name -> (n_cycles, length) array
+    chambers -- np.array
+        chamber id of each cycle
+    """
+
+    def __init__(self, starts, values, chambers=None):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.values = values
+        self.chambers = chambers
+        self.length = next(iter(values.values())).shape[1]
+        self.mask = ~np.isnan(values[next(iter(values))])
+
+    @classmethod
+    def from_frame(
+        cls, df, starts, chambers=None, columns=GASES, length=CYCLE_LENGTH_S
+    ):
+        """
+        Build the matrix from one frame covering many cycles, eg. a whole day.
+
+        Every row of df is placed by searching the cycle it belongs to, so
+        the data is never sliced per cycle.
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        n = len(starts)
+        values = {c: np.full((n, length), np.nan) for c in columns}
+        if df is not None and not df.empty:
+            t = pd.DatetimeIndex(df.index).asi8
+            row = np.searchsorted(starts, t, side="right") - 1
+            sec = np.rint((t - starts[np.maximum(row, 0)]) / 1e9).astype(np.int64)
+            ok = (row >= 0) & (sec >= 0) & (sec < length)
+            for c in columns:
+                values[c][row[ok], sec[ok]] = df[c].to_numpy(dtype=float)[ok]
+        return cls(starts, values, chambers)
+
+    def window_sums(self, column, lo, hi):
+        """
+        Sums needed for r and slope over [lo, hi) seconds of every row.
+
+        lo and hi can be (n,) for one window per row or (n, m) for many.
+
+        returns:
+        ---
+        n, sum x, sum y, sum xy, sum x^2, sum y^2 and the count of missing
+        values in each window, x in seconds from start
+        """
+        y = self.values[column]
+        valid = ~np.isnan(y)
+        # centered per row so that the sums stay well conditioned
+        with warnings.catch_warnings():
+            # rows without data are expected
+            warnings.simplefilter("ignore", RuntimeWarning)
+            y = np.where(valid, y - np.nanmean(y, axis=1, keepdims=True), 0.0)
+        x = np.where(valid, np.arange(self.length, dtype=float), 0.0)
+
+        lo, hi = np.asarray(lo), np.asarray(hi)
+        if lo.ndim < 2:
+            lo, hi = self.per_row(lo), self.per_row(hi)
+        lo = np.clip(lo, 0, self.length).astype(np.int64)
+        hi = np.clip(hi, 0, self.length).astype(np.int64)
+        squeeze = lo.ndim == 1
+        if squeeze:
+            lo, hi = lo[:, None], hi[:, None]
+
+        def wsum(a):
+            c = prefix_sum(a)
+            s = np.take_along_axis(c, hi, axis=1) - np.take_along_axis(c, lo, axis=1)
+            return s[:, 0] if squeeze else s
+
+        n = wsum(valid.astype(float))
+        missing = (hi - lo)[:, 0] - n if squeeze else (hi - lo) - n
+        return n, wsum(x), wsum(y), wsum(x * y), wsum(x * x), wsum(y * y), missing
+
+    def slope(self, column, close, open):
+        """OLS slope in units per second over [close, open) of every row."""
+        n, sx, sy, sxy, sxx, _, _ = self.window_sums(column, close, open)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (n * sxy - sx * sy) / (n * sxx - sx**2)
+
+    def windowed_r(self, column, close, open, window=180, step=20):
+        """
+        Pearsons R of every window start first + k * step before open, like
+        get_max_r. first is the first second of the row with data at or
+        after close, windows are cut at open and need 90 % coverage.
+
+        returns:
+        ---
+        (n, m) array of window start offsets and (n, m) array of abs r
+        """
+        close = self.per_row(close)
+        open = self.per_row(open)
+        cols = np.arange(self.length)
+        valid = (
+            ~np.isnan(self.values[column])
+            & (cols >= close[:, None])
+            & (cols < open[:, None])
+        )
+        has_data = valid.any(axis=1)
+        first = np.where(has_data, np.argmax(valid, axis=1), close)
+        last = np.where(
+            has_data, self.length - 1 - np.argmax(valid[:, ::-1], axis=1), close
+        )
+        m = int(np.max(last - first, initial=0)) // step + 1
+        lo = first[:, None] + step * np.arange(m)[None, :]
+        hi = np.minimum(lo + window, open[:, None])
+        n, sx, sy, sxy, sxx, syy, missing = self.window_sums(column, lo, hi)
+        var = (n * sxx - sx**2) * (n * syy - sy**2)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            r = np.round(np.abs((n * sxy - sx * sy) / np.sqrt(var)), 8)
+        r[(n <= window * 0.9) | (lo > last[:, None]) | ~has_data[:, None]] = np.nan
+        return lo, r
+
+    def max_r(self, column, close, open, window=180, step=20):
+        """Best window of every row, returns (r, offset), 0 where no window."""
+        offsets, r = self.windowed_r(column, close, open, window, step)
+        has_r = ~np.isnan(r).all(axis=1)
+        best = np.argmax(np.where(np.isnan(r), -np.inf, r), axis=1)
+        rows = np.arange(len(r))
+        max_r = np.where(has_r, r[rows, best], 0.0)
+        offset = np.where(has_r, offsets[rows, best], 0)
+        return max_r, offset
+
+    def lag(self, open=720, lag_window=120, column="CH4"):
+        """
+        Seconds from open to the maximum of column in [open, open + window),
+        moved back with the same rules as MeasurementCycle.get_lagtime. open
+        can be an int or one offset per row.
+        """
+        open = self.per_row(open)
+        lags = [self.argmax(column, open, open + lag_window) - open]
+        for shift in LAG_SHIFTS_S:
+            start = open - shift
+            lags.append(self.argmax(column, start, start + lag_window) - open)
+        return pick_lag(*lags)
+
+    def argmax(self, column, lo, hi):
+        """Offset of the first maximum in [lo, hi) of every row, nan if none."""
+        values = self.values[column]
+        cols = np.arange(self.length)
+        inside = (
+            (cols >= self.per_row(lo)[:, None])
+            & (cols < self.per_row(hi)[:, None])
+            & ~np.isnan(values)
+        )
+        best = np.argmax(np.where(inside, values, -np.inf), axis=1)
+        return np.where(inside.any(axis=1), best, np.nan)
+
+    def per_row(self, offsets):
+        """Broadcast an int or an array of offsets to one int per row."""
+        offsets = np.asarray(offsets, dtype=np.int64)
+        return np.broadcast_to(offsets, (len(self.starts),))
+
+    def diag_sum(self, close, open):
+        """Sum of DIAG over [close, open) of every row."""
+        c = prefix_sum(np.nan_to_num(self.values["DIAG"]))
+        close = np.clip(self.per_row(close), 0, self.length)[:, None]
+        open = np.clip(self.per_row(open), 0, self.length)[:, None]
+        s = np.take_along_axis(c, open, axis=1) - np.take_along_axis(c, close, axis=1)
+        return s[:, 0]
+
+    def compute(self, close=240, open=720):
+        """
+        Run lag, max r, slope, diagnostics and the quality rules for every
+        cycle like MeasurementCycle.set_data does for one. close and open
+        are ints or one offset per row.
+
+        Rows without data are not valid and have no_data_in_db set, rows
+        without data in the lag window are not valid without a lag like in
+        MeasurementCycle.get_max.
+
+        returns:
+        ---
+        pandas.DataFrame with one row per cycle indexed by start
+        """
+        close = self.per_row(close)
+        open = self.per_row(open)
+        ch4_r, ch4_r_offset = self.max_r("CH4", close, open)
+        co2_r, co2_r_offset = self.max_r("CO2", close, open)
+        cols = np.arange(self.length)
+        window = (cols >= close[:, None]) & (cols < open[:, None])
+        n = (self.mask & window).sum(axis=1)
+
+        has_data = self.mask.any(axis=1)
+        got_lag = ~np.isnan(self.argmax("CH4", open, open + 120))
+        lag = np.where(got_lag, self.lag(open), 0.0)
+        lag_close = close + np.rint(lag).astype(np.int64)
+        failed = evaluate_rules(self, lag_close, open, ch4_r)
+        failed.loc[~got_lag, :] = False
+        names = [",".join(f) for f in failed_rules(failed)]
+        return pd.DataFrame(
+            {
+                "chamber": self.chambers,
+                "lagtime_s": lag,
+                "got_lag": got_lag,
+                "ch4_r": ch4_r,
+                "ch4_r_offset": ch4_r_offset,
+                "co2_r": co2_r,
+                "co2_r_offset": co2_r_offset,
+                "ch4_slope": self.slope("CH4", close, open),
+                "co2_slope": self.slope("CO2", close, open),
+                "diag_sum": self.diag_sum(close, open),
+                "coverage": n / np.maximum(open - close, 1),
+                "is_valid": got_lag & ~failed.any(axis=1).to_numpy(),
+                "has_errors": failed["diag"].to_numpy(),
+                "no_data_in_db": ~has_data,
+                "failed_rules": names,
+            },
+            index=pd.to_datetime(self.starts, unit="ns", utc=True).rename("start"),
+        )
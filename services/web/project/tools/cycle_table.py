@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+
+from project.tools.measurement import MeasurementCycle
+
+logger = logging.getLogger("defaultLogger")
+
+NS = 10**9
+
+# manual_valid is stored as int8, None is kept as -1
+MANUAL_UNSET = -1
+
+
+class CycleTable:
+    """
+    Columnar table of measurement cycles.
+
+    Times are int64 ns UTC, offsets are seconds from start. Everything that is
+    needed for sorting and filtering lives in numpy arrays, a full
+    MeasurementCycle is only created when a row is actually looked at, with
+    cycle(). After a cycle has been modified sync() copies its state back
+    into the arrays.
+    """
+
+    def __init__(self, chambers, starts, closes, opens, ends):
+        n = len(starts)
+        self.chamber = np.asarray(chambers)
+        self.start = np.asarray(starts, dtype=np.int64)
+        self.end = np.asarray(ends, dtype=np.int64)
+        self.close_offset = (np.asarray(closes, dtype=np.int64) - self.start) // NS
+        self.open_offset = (np.asarray(opens, dtype=np.int64) - self.start) // NS
+        self.og_close_offset = self.close_offset.copy()
+        self.og_open_offset = self.open_offset.copy()
+        self.lagtime_s = np.zeros(n)
+        self.got_lag = np.zeros(n, dtype=bool)
+        self.ch4_r = np.zeros(n)
+        self.co2_r = np.zeros(n)
+        self.ch4_r_offset = np.zeros(n)
+        self.co2_r_offset = np.zeros(n)
+        self.is_valid = np.ones(n, dtype=bool)
+        self.has_errors = np.zeros(n, dtype=bool)
+        self.no_data_in_db = np.zeros(n, dtype=bool)
+        self.manual_valid = np.full(n, MANUAL_UNSET, dtype=np.int8)
+        self.failed_rules = np.full(n, "", dtype=object)
+        # rows whose stored results have been looked up
+        self.loaded = np.zeros(n, dtype=bool)
+        self._cycles = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.start)
+
+    @property
+    def close(self):
+        return self.start + ((self.close_offset + self.lagtime_s) * NS).astype(np.int64)
+
+    @property
+    def open(self):
+        return self.start + self.open_offset * NS
+
+    def chamber_ids(self):
+        """Chambers in the order they first appear."""
+        return list(pd.unique(self.chamber))
+
+    def select(self, chambers, until=None):
+        """
+        Rows of the given chambers sorted by open time, if until is given
+        only the cycles that have started by then.
+        """
+        keep = np.isin(self.chamber, chambers)
+        if until is not None:
+            keep &= self.start <= until.value
+        idx = np.flatnonzero(keep)
+        idx = idx[np.argsort(self.open[idx], kind="stable")]
+        return CycleSelection(self, idx)
+
+    def between(self, start, end):
+        """Rows starting in [start, end), start and end are pd.Timestamps."""
+        idx = np.flatnonzero((self.start >= start.value) & (self.start < end.value))
+        return CycleSelection(self, idx)
+
+    def frame(self, idx=None):
+        """
+        The rows as a DataFrame with UTC datetime start, close, open and end
+        columns, close includes the lag time.
+        """
+        idx = np.arange(len(self)) if idx is None else np.asarray(idx)
+
+        def utc(values):
+            return pd.to_datetime(values, unit="ns", utc=True)
+
+        return pd.DataFrame(
+            {
+                "chamber": self.chamber[idx],
+                "start": utc(self.start[idx]),
+                "close": utc(self.close[idx]),
+                "open": utc(self.open[idx]),
+                "end": utc(self.end[idx]),
+                "lagtime_s": self.lagtime_s[idx],
+                "is_valid": self.is_valid[idx],
+            },
+            index=idx,
+        )
+
+    def find(self, ts):
+        """Row of the cycle that starts last at or before ts, -1 if none."""
+        return int(np.searchsorted(self.start, ts.value, side="right")) - 1
+
+    def row(self, i):
+        return CycleRow(self, i)
+
+    def is_materialized(self, i):
+        return int(i) in self._cycles
+
+    def cycle(self, i):
+        """Return the MeasurementCycle of row i, created on first use."""
+        i = int(i)
+        with self._lock:
+            return self._materialize(i)
+
+    def _materialize(self, i):
+        cycle = self._cycles.get(i)
+        if cycle is None:
+            cycle = MeasurementCycle(
+                self.chamber[i],
+                pd.Timestamp(self.start[i], tz="UTC"),
+                pd.Timestamp(self.start[i] + self.og_close_offset[i] * NS, tz="UTC"),
+                pd.Timestamp(self.start[i] + self.og_open_offset[i] * NS, tz="UTC"),
+                pd.Timestamp(self.end[i], tz="UTC"),
+            )
+            self._restore(cycle, i)
+            self._cycles[i] = cycle
+        return cycle
+
+    def sync(self, i):
+        """Copy the state of the MeasurementCycle of row i into the arrays."""
+        i = int(i)
+        cycle = self._cycles.get(i)
+        if cycle is None:
+            return
+        self.close_offset[i] = cycle.close_offset
+        self.open_offset[i] = cycle.open_offset
+        self.lagtime_s[i] = cycle.lagtime_s
+        self.got_lag[i] = bool(cycle.got_lag)
+        self.ch4_r[i] = cycle.ch4_r
+        self.co2_r[i] = cycle.co2_r
+        self.ch4_r_offset[i] = cycle.ch4_r_offset
+        self.co2_r_offset[i] = cycle.co2_r_offset
+        self.is_valid[i] = cycle.is_valid
+        self.has_errors[i] = cycle.has_errors
+        self.no_data_in_db[i] = cycle.no_data_in_db
+        self.manual_valid[i] = (
+            MANUAL_UNSET if cycle.manual_valid is None else int(cycle.manual_valid)
+        )
+        self.failed_rules[i] = ",".join(cycle.failed_rules)
+
+    def _restore(self, cycle, i):
+        cycle.close_offset = int(self.close_offset[i])
+        cycle.open_offset = int(self.open_offset[i])
+        if self.got_lag[i]:
+            cycle.got_lag = True
+            cycle.lagtime_s = float(self.lagtime_s[i])
+        cycle.ch4_r = float(self.ch4_r[i])
+        cycle.co2_r = float(self.co2_r[i])
+        cycle.ch4_r_offset = float(self.ch4_r_offset[i])
+        cycle.co2_r_offset = float(self.co2_r_offset[i])
+        cycle.is_valid = bool(self.is_valid[i])
+        cycle.has_errors = bool(self.has_errors[i])
+        cycle.no_data_in_db = bool(self.no_data_in_db[i])
+        cycle.failed_rules = [r for r in self.failed_rules[i].split(",") if r]
+        if self.manual_valid[i] != MANUAL_UNSET:
+            cycle.manual_valid = bool(self.manual_valid[i])
+
+
+class CycleRow:
+    """Lightweight read-only view of one row of a CycleTable."""
+
+    __slots__ = ("table", "i")
+
+    def __init__(self, table, i):
+        self.table = table
+        self.i = i
+
+    @property
+    def id(self):
+        return self.table.chamber[self.i]
+
+    @property
+    def start(self):
+        return pd.Timestamp(self.table.start[self.i], tz="UTC")
+
+    @property
+    def end(self):
+        return pd.Timestamp(self.table.end[self.i], tz="UTC")
+
+    @property
+    def close(self):
+        t = self.table
+        offset = t.close_offset[self.i] + t.lagtime_s[self.i]
+        return pd.Timestamp(t.start[self.i] + int(offset * NS), tz="UTC")
+
+    @property
+    def open(self):
+        t = self.table
+        return pd.Timestamp(t.start[self.i] + t.open_offset[self.i] * NS, tz="UTC")
+
+    @property
+    def lagtime_s(self):
+        return self.table.lagtime_s[self.i]
+
+    @property
+    def is_valid(self):
+        return bool(self.table.is_valid[self.i])
+
+    def cycle(self):
+        return self.table.cycle(self.i)
+
+
+class CycleSelection:
+    """Sequence of CycleRows, a subset of a CycleTable in a given order."""
+
+    def __init__(self, table, idx):
+        self.table = table
+        self.idx = idx
+
+    def __len__(self):
+        return len(self.idx)
+
+    def __bool__(self):
+        return len(self.idx) > 0
+
+    def __getitem__(self, i):
+        return CycleRow(self.table, self.idx[i])
+
+    def __iter__(self):
+        return (CycleRow(self.table, i) for i in self.idx)
+
+    def cycles(self):
+        """Materialize the MeasurementCycles of every row."""
+        return [self.table.cycle(i) for i in self.idx]
+
+    def frame(self):
+        return self.table.frame(self.idx)
+
+    def sync(self):
+        for i in self.idx:
+            self.table.sync(i)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+from project.tools.cycle_matrix import CycleMatrix
+from project.tools.gas_funcs import calculate_gas_fluxes
+from project.tools.influxdb_funcs import read_ifdb
+from project.tools.licor_cache import cached_read, get_cache
+from project.tools.measurement import LICOR_MEAS
+
+logger = logging.getLogger("defaultLogger")
+
+# can be overridden with met_meas_dict in config.json
+MET_MEAS = {"measurement": "AC WEATHER", "fields": "air_temperature,air_pressure"}
+MET_COLUMNS = ["air_temperature", "air_pressure"]
+# how old a met value can be when there is none during the cycle
+MET_TOLERANCE = pd.Timedelta(minutes=30)
+FLUX_GASES = ["CH4", "CO2"]
+
+
+def to_frame(df):
+    """Query result with a datetime column to a sorted time indexed frame."""
+    if df is None or df.empty:
+        return None
+    df = df.set_index("datetime")
+    df.index = pd.to_datetime(df.index, utc=True)
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
+    return df
+
+
+def window_means(df, lo, hi):
+    """
+    Mean of every column of df over each [lo, hi) window with cumulative
+    sums, nan for windows without data.
+
+    args:
+    ---
+    df -- pandas.DataFrame
+        time indexed data
+    lo, hi -- np.array
+        int64 ns window limits
+
+    returns:
+    ---
+    dict of column -> np.array
+    """
+    t = df.index.asi8
+    a = np.searchsorted(t, lo, side="left")
+    b = np.searchsorted(t, hi, side="left")
+    means = {}
+    for column in df.columns:
+        values = df[column].to_numpy(dtype=float)
+        valid = ~np.isnan(values)
+        c = np.concatenate(([0.0], np.cumsum(np.where(valid, values, 0.0))))
+        n = np.concatenate(([0], np.cumsum(valid)))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means[column] = (c[b] - c[a]) / (n[b] - n[a])
+    return means
+
+
+def join_met(cycles, met):
+    """
+    Air temperature and pressure of every cycle.
+
+    The mean over close - open is used, cycles without met data in that
+    window get the last value before close with an as-of join.
+
+    args:
+    ---
+    cycles -- pandas.DataFrame
+        with close and open columns, sorted by close
+    met -- pandas.DataFrame
+        time indexed met data, can be None
+
+    returns:
+    ---
+    pandas.DataFrame with MET_COLUMNS, same index as cycles
+    """
+    out = pd.DataFrame(np.nan, index=cycles.index, columns=MET_COLUMNS)
+    if met is None:
+        return out
+    met = met[[c for c in MET_COLUMNS if c in met.columns]]
+    lo = pd.DatetimeIndex(cycles["close"]).asi8
+    hi = pd.DatetimeIndex(cycles["open"]).asi8
+    means = window_means(met, lo, hi)
+    for column, values in means.items():
+        out[column] = values
+
+    nearest = pd.merge_asof(
+        cycles[["close"]].reset_index(drop=True),
+        met,
+        left_on="close",
+        right_index=True,
+        direction="backward",
+        tolerance=MET_TOLERANCE,
+    )
+    for column in met.columns:
+        out[column] = out[column].fillna(pd.Series(nearest[column].values, out.index))
+    return out
+
+
+def cycle_met(cycle, ifdb_dict, met_meas=MET_MEAS):
+    """
+    Air temperature and pressure of one cycle, averaged over close - open
+    like join_met does for flux_table, queried once and kept in cycle.met.
+    """
+    if cycle.met is None:
+        met = to_frame(
+            read_ifdb(ifdb_dict, met_meas, cycle.start - MET_TOLERANCE, cycle.end)
+        )
+        row = pd.DataFrame({"close": [cycle.close], "open": [cycle.open]})
+        cycle.met = join_met(row, met).iloc[0].to_dict()
+    return cycle.met
+
+
+def flux_table(cycles, licor, met, heights):
+    """
+    Slopes and fluxes of every cycle in one pass.
+
+    args:
+    ---
+    cycles -- pandas.DataFrame
+        CycleTable.frame() of the cycles
+    licor -- pandas.DataFrame
+        time indexed gas data covering the cycles
+    met -- pandas.DataFrame
+        time indexed met data, can be None
+    heights -- dict
+        chamber id (as str) -> chamber height in m, chambers without a
+        height get nan flux
+
+    returns:
+    ---
+    pandas.DataFrame indexed by cycle start
+    """
+    cycles = cycles.sort_values("start")
+    start = pd.DatetimeIndex(cycles["start"])
+    close = pd.DatetimeIndex(cycles["close"])
+    open = pd.DatetimeIndex(cycles["open"])
+    close_s = (close.asi8 - start.asi8) // 10**9
+    open_s = (open.asi8 - start.asi8) // 10**9
+    chambers = cycles["chamber"].to_numpy()
+    matrix = CycleMatrix.from_frame(licor, start.asi8, chambers, columns=FLUX_GASES)
+
+    out = pd.DataFrame(
+        {"chamber": chambers, "close": close, "open": open},
+        index=start.rename("start"),
+    )
+    by_close = out.sort_values("close")
+    out = out.join(join_met(by_close, met))
+    out["chamber_height"] = out["chamber"].astype(str).map(heights).astype(float)
+    for gas in FLUX_GASES:
+        slope = matrix.slope(gas, close_s, open_s)
+        out[f"{gas.lower()}_slope"] = slope
+        out[f"{gas.lower()}_flux"] = calculate_gas_fluxes(
+            slope,
+            gas,
+            out["air_temperature"],
+            out["air_pressure"],
+            out["chamber_height"],
+        )
+    return out
+
+
+def load_flux_table(cycles, ifdb_dict, met_meas=MET_MEAS, heights=None):
+    """
+    Fetch the data and calculate the flux table of many cycles.
+
+    Gas data is read one UTC day at a time through the LI-COR cache, met
+    data with one query for the whole range.
+
+    args:
+    ---
+    cycles -- pandas.DataFrame
+        CycleTable.frame() of the cycles
+    ifdb_dict -- dict
+        influxdb config
+    met_meas -- dict
+        measurement and fields of the met data
+    heights -- dict
+        chamber id (as str) -> chamber height in m
+    """
+    if cycles.empty:
+        return None
+    heights = heights or {}
+    days = cycles["start"].dt.floor("D")
+    groups = [group for _, group in cycles.groupby(days)]
+    ranges = [(g["start"].min(), g["end"].max()) for g in groups]
+    get_cache(ifdb_dict).warm(ifdb_dict, LICOR_MEAS, ranges)
+
+    start, stop = cycles["start"].min(), cycles["end"].max()
+    met = to_frame(read_ifdb(ifdb_dict, met_meas, start - MET_TOLERANCE, stop))
+    if met is None:
+        logger.info("No met data, fluxes can't be calculated.")
+
+    tables = []
+    for group, (s, e) in zip(groups, ranges):
+        licor = to_frame(cached_read(ifdb_dict, LICOR_MEAS, start_ts=s, stop_ts=e))
+        tables.append(flux_table(group, licor, met, heights))
+    logger.debug(f"Calculated fluxes for {len(cycles)} cycles.")
+    return pd.concat(tables).sort_index()
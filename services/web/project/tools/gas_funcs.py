@@ -9,6 +9,9 @@ logger = logging.getLogger("defaultLogger")
 masses = {"CH4": 16, "CO2": 44, "H2O": 18}
 # conversions to ppm
 convs = {"CH4": 1000, "CO2": 1, "H2O": 1}
+# how far back the lag window is moved when the maximum is at open and when
+# it is at the end of the window
+LAG_SHIFTS_S = (120, 100)
 
 
 def calculate_gas_flux(df, measurement_name, slope, chamber_height):
@@ -28,20 +31,47 @@ def calculate_gas_flux(df, measurement_name, slope, chamber_height):
         one column for the dataframe with the calculated gas
         flux
     """
-    # this value must in m
-    h = chamber_height
+    t = df["air_temperature"].mean()
+    p = df["air_pressure"].mean()
+    return calculate_gas_fluxes(slope, measurement_name, t, p, chamber_height)
+
+
+def calculate_gas_fluxes(slope, measurement_name, temperature, pressure, height):
+    """
+    Calculates gas flux for any number of measurements at once
+
+    args:
+    ---
+    slope : numpy.array
+        slopes in ppX/s
+    measurement_name : str
+        name of the gas
+    temperature : numpy.array
+        air temperature in C
+    pressure : numpy.array
+        air pressure in hPa
+    height : numpy.array
+        chamber height in m
+
+    returns:
+    ---
+    flux : numpy.array
+        flux in mg/m2/h, nan where any of the inputs is missing
+    """
     # molar_mass
     m = masses.get(measurement_name)
     # value to convert to ppm
     conv = convs.get(measurement_name)
     # C temperature to K
-    t = df["air_temperature"].mean() + 273.15
+    t = np.asarray(temperature, dtype=float) + 273.15
     # hPa to Pa
-    p = df["air_pressure"].mean() * 100
+    p = np.asarray(pressure, dtype=float) * 100
+    # this value must in m
+    h = np.asarray(height, dtype=float)
     # universal gas constant
     r = 8.314
     # convert slope from ppX/s to ppm/hour
-    slope = (slope / conv) * 60 * 60
+    slope = (np.asarray(slope, dtype=float) / conv) * 60 * 60
 
     # flux in mg/m2/h
     flux = slope / 1000000 * h * ((m * p) / (r * t)) * 1000
@@ -73,6 +103,177 @@ def calculate_pearsons_r(x, y):
     return pearsons_r
 
 
+def sliding_pearsons_r(t, y, window, step, min_count=0):
+    """
+    Calculates pearsons R for every window [t0 + k * step, t0 + k * step +
+    window) over the series in one pass, using cumulative sums of x, y, xy,
+    x^2 and y^2.
+
+    Parameters
+    ----------
+    t : np.array
+        sorted int64 timestamps in ns
+    y : np.array
+        gas values
+    window : int
+        window length in ns
+    step : int
+        step between window starts in ns
+    min_count : int
+        windows with this many points or less get nan
+
+    Returns
+    -------
+    starts : np.array
+        int64 start of each window
+    pearsons_r : np.array
+        absolute pearsons R of each window rounded like calculate_pearsons_r
+    """
+    t = np.asarray(t, dtype=np.int64)
+    if len(t) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    # relative seconds and centered values keep the sums well conditioned
+    x = (t - t[0]) / 1e9
+    y = np.asarray(y, dtype=np.float64)
+    missing = np.isnan(y)
+    y = np.where(missing, 0.0, y - np.nanmean(y)) if missing.any() else y - y.mean()
+
+    def cumsum(a):
+        return np.concatenate(([0.0], np.cumsum(a)))
+
+    sx, sy = cumsum(x), cumsum(y)
+    sxy, sxx, syy = cumsum(x * y), cumsum(x * x), cumsum(y * y)
+
+    starts = t[0] + np.arange((t[-1] - t[0]) // step + 1, dtype=np.int64) * step
+    lo = np.searchsorted(t, starts, side="left")
+    hi = np.searchsorted(t, starts + window, side="left")
+    n = hi - lo
+
+    def window_sum(c):
+        return c[hi] - c[lo]
+
+    w_sx, w_sy = window_sum(sx), window_sum(sy)
+    cov = n * window_sum(sxy) - w_sx * w_sy
+    var_x = n * window_sum(sxx) - w_sx**2
+    var_y = n * window_sum(syy) - w_sy**2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        pearsons_r = np.round(np.abs(cov / np.sqrt(var_x * var_y)), 8)
+    pearsons_r[n <= min_count] = np.nan
+    # like np.corrcoef, a window with missing values has no r
+    pearsons_r[window_sum(cumsum(missing)) > 0] = np.nan
+    return starts, pearsons_r
+
+
+class PrefixSums:
+    """
+    Cumulative sums of x, y, xy, x^2 and y^2 of one gas series, so that the
+    slope and pearsons R of any time window only take two searchsorted
+    calls and a few subtractions, whatever the size of the window.
+
+    Parameters
+    ----------
+    t : np.array
+        sorted int64 timestamps in ns
+    y : np.array
+        gas values, nan values are left out
+    """
+
+    def __init__(self, t, y):
+        t = np.asarray(t, dtype=np.int64)
+        y = np.asarray(y, dtype=np.float64)
+        valid = ~np.isnan(y)
+        self.t = t[valid]
+        y = y[valid]
+        if len(self.t) == 0:
+            self.sums = None
+            return
+        # relative seconds and centered values keep the sums well conditioned
+        x = (self.t - self.t[0]) / 1e9
+        y = y - y.mean()
+
+        def cumsum(a):
+            return np.concatenate(([0.0], np.cumsum(a)))
+
+        self.sums = [cumsum(a) for a in (x, y, x * y, x * x, y * y)]
+
+    def window(self, start, end):
+        """
+        Slope in units per second and pearsons R over [start, end) in ns.
+
+        Returns
+        -------
+        n : int
+            number of points in the window
+        slope : float
+            nan with less than two points
+        pearsons_r : float
+            absolute pearsons R rounded like calculate_pearsons_r
+        """
+        if self.sums is None:
+            return 0, np.nan, np.nan
+        a = np.searchsorted(self.t, start, side="left")
+        b = np.searchsorted(self.t, end, side="left")
+        n = b - a
+        sx, sy, sxy, sxx, syy = (c[b] - c[a] for c in self.sums)
+        cov = n * sxy - sx * sy
+        var_x = n * sxx - sx**2
+        var_y = n * syy - sy**2
+        if n < 2 or var_x <= 0:
+            return n, np.nan, np.nan
+        slope = cov / var_x
+        r = np.nan if var_y <= 0 else round(abs(cov / np.sqrt(var_x * var_y)), 8)
+        return n, slope, r
+
+
+def window_argmax(t, y, starts, ends):
+    """
+    Position of the first maximum of y in every [start, end) of t, like
+    Series.idxmax on each window, but from one array without slicing.
+
+    Parameters
+    ----------
+    t : np.array
+        sorted int64 timestamps in ns
+    y : np.array
+        gas values
+    starts, ends : np.array
+        int64 window limits in ns
+
+    Returns
+    -------
+    np.array of positions in t, -1 for windows with no data
+    """
+    lo = np.searchsorted(t, starts, side="left")
+    hi = np.searchsorted(t, ends, side="left")
+    idx = np.full(len(lo), -1, dtype=np.int64)
+    for k, (a, b) in enumerate(zip(lo, hi)):
+        window = y[a:b]
+        if window.size and not np.isnan(window).all():
+            idx[k] = a + np.nanargmax(window)
+    return idx
+
+
+def pick_lag(first, at_open, at_end):
+    """
+    Choose the lag in seconds from the maxima of the candidate windows.
+
+    If the maximum is right at open the lag is taken from the window moved
+    back 120 s, if it is 110 s or more after open from the window moved back
+    100 s. A moved window with no data keeps the first lag. Works on scalars
+    and on arrays.
+
+    Parameters
+    ----------
+    first : float
+        lag of the maximum in the unshifted window
+    at_open, at_end : float
+        lags of the maxima in the windows moved back by LAG_SHIFTS_S
+    """
+    first = np.nan_to_num(first)
+    lag = np.where((first == 0) & ~np.isnan(at_open), at_open, first)
+    return np.where((first >= 110) & ~np.isnan(at_end), at_end, lag)
+
+
 def calculate_slope(x, y):
     slope = round(
         np.polyfit(x.astype(float), y.astype(float), 1).item(0),
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+import atexit
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from influxdb_client import Point, WritePrecision
+from influxdb_client.rest import ApiException
+from urllib3.exceptions import HTTPError
+
+from project.tools.client_pool import client_key, get_write_api
+
+logger = logging.getLogger("defaultLogger")
+
+SPOOL_DIR = os.getenv("IFDB_SPOOL_DIR", "spool")
+BATCH_SIZE = int(os.getenv("IFDB_BATCH_SIZE", 5000))
+FLUSH_INTERVAL_S = float(os.getenv("IFDB_FLUSH_INTERVAL_S", 2))
+MAX_RETRIES = int(os.getenv("IFDB_MAX_RETRIES", 5))
+RETRY_BASE_S = 1
+RETRY_MAX_S = 60
+
+_STOP = object()
+# results of IfdbWriter._write
+WRITTEN, FAILED, REJECTED = "written", "failed", "rejected"
+
+
+def is_retryable(e):
+    """Connection errors, timeouts, 429 and 5xx responses may succeed later."""
+    if isinstance(e, ApiException):
+        return e.status is None or e.status == 429 or e.status >= 500
+    return isinstance(e, (HTTPError, OSError))
+
+
+class IfdbWriter:
+    """
+    Background writer for one bucket.
+
+    Submitted line protocol is batched and written from a worker thread when
+    BATCH_SIZE lines have piled up or FLUSH_INTERVAL_S has passed. Failed
+    writes are retried with exponential backoff and batches that still fail
+    are appended to a spool file. The spool is replayed when the writer
+    starts and after every successful write, so nothing is lost while the
+    database is down. Every process writing to the bucket shares the spool,
+    appends and the rename before a replay hold a flock on a lock file next
+    to it. Batches the database refuses, eg. bad line protocol or a wrong
+    bucket, are not retried but moved to a rejected file that is never
+    replayed.
+    """
+
+    def __init__(self, ifdb_dict):
+        self.ifdb_dict = ifdb_dict
+        self.bucket = ifdb_dict.get("bucket")
+        url, org, _ = client_key(ifdb_dict)
+        name = hashlib.sha1(f"{url}|{org}|{self.bucket}".encode()).hexdigest()[:16]
+        self.spool_path = os.path.join(SPOOL_DIR, f"{name}.jsonl")
+        self.rejected_path = os.path.join(SPOOL_DIR, f"{name}.rejected.jsonl")
+        self.lock_path = os.path.join(SPOOL_DIR, f"{name}.lock")
+        self.queue = queue.Queue()
+        self._spool_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._thread = threading.Thread(
+                target=self._run, name=f"ifdb-writer-{self.bucket}", daemon=True
+            )
+            self._thread.start()
+
+    def submit(self, lines):
+        """Queue line protocol strings for writing, returns immediately."""
+        lines = list(lines)
+        if not lines:
+            return
+        self.start()
+        self.queue.put(lines)
+
+    def flush(self, timeout=10):
+        """Block until everything submitted so far is written or spooled."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        if not done.wait(timeout):
+            logger.warning(f"Flushing {self.bucket} timed out.")
+
+    def stop(self, timeout=10):
+        """Flush what is queued, spool it if it can't be written."""
+        if self._thread is None:
+            return
+        self._stopping = True
+        self.queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def _run(self):
+        self._replay()
+        batch = []
+        deadline = None
+        while True:
+            wait = FLUSH_INTERVAL_S if deadline is None else deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=max(wait, 0))
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                self._flush(batch)
+                return
+            if isinstance(item, threading.Event):
+                self._flush(batch)
+                batch = []
+                deadline = None
+                item.set()
+                continue
+            if item:
+                if not batch:
+                    deadline = time.monotonic() + FLUSH_INTERVAL_S
+                batch.extend(item)
+            if batch and (len(batch) >= BATCH_SIZE or time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+                deadline = None
+
+    def _flush(self, lines):
+        for i in range(0, len(lines), BATCH_SIZE):
+            chunk = lines[i : i + BATCH_SIZE]
+            result = self._write(chunk)
+            if result == WRITTEN:
+                if self._has_spool():
+                    self._replay()
+            elif result == REJECTED:
+                self._reject(chunk)
+            else:
+                self._spool(chunk)
+
+    def _write(self, lines):
+        retries = 0 if self._stopping else MAX_RETRIES
+        for attempt in range(retries + 1):
+            try:
+                get_write_api(self.ifdb_dict).write(
+                    bucket=self.bucket,
+                    record=lines,
+                    write_precision=WritePrecision.NS,
+                )
+                logger.debug(f"Wrote {len(lines)} lines to {self.bucket}.")
+                return WRITTEN
+            except Exception as e:
+                if not is_retryable(e):
+                    logger.error(f"Write to {self.bucket} was rejected: {e}")
+                    return REJECTED
+                logger.warning(f"Write to {self.bucket} failed: {e}")
+                if attempt < retries:
+                    time.sleep(min(RETRY_BASE_S * 2**attempt, RETRY_MAX_S))
+        return FAILED
+
+    def _spool(self, lines):
+        logger.warning(f"Spooling {len(lines)} lines to {self.spool_path}.")
+        self._append(self.spool_path, lines)
+
+    def _reject(self, lines):
+        logger.error(f"Moving {len(lines)} lines to {self.rejected_path}.")
+        self._append(self.rejected_path, lines)
+
+    @contextmanager
+    def _file_lock(self):
+        """Lock the spool files against the other threads and processes."""
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        with self._spool_lock, open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _append(self, path, lines):
+        with self._file_lock():
+            with open(path, "a") as f:
+                f.write(json.dumps(lines) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _has_spool(self):
+        return os.path.exists(self.spool_path)
+
+    def _replay(self):
+        if not self._has_spool():
+            return
+        # take the spool away first so that failed batches can be appended to
+        # a new one while replaying
+        replay_path = f"{self.spool_path}.{os.getpid()}.replay"
+        with self._file_lock():
+            try:
+                os.replace(self.spool_path, replay_path)
+            except FileNotFoundError:
+                return
+        logger.info(f"Replaying spooled writes from {self.spool_path}.")
+        failed = False
+        with open(replay_path, "r") as f:
+            for row in f:
+                if not row.strip():
+                    continue
+                lines = json.loads(row)
+                result = FAILED if failed else self._write(lines)
+                if result == REJECTED:
+                    self._reject(lines)
+                elif result == FAILED:
+                    failed = True
+                    self._spool(lines)
+        os.remove(replay_path)
+
+
+_lock = threading.Lock()
+_writers = {}
+
+
+def get_writer(ifdb_dict):
+    key = client_key(ifdb_dict) + (ifdb_dict.get("bucket"),)
+    with _lock:
+        writer = _writers.get(key)
+        if writer is None:
+            writer = IfdbWriter(ifdb_dict)
+            _writers[key] = writer
+    return writer
+
+
+def points_to_lines(point_data):
+    """Serialize point dicts, points without a time get the submit time."""
+    lines = []
+    for point in point_data:
+        if point.get("time") is None:
+            point = {**point, "time": datetime.now(timezone.utc)}
+        lines.append(
+            Point.from_dict(point, write_precision=WritePrecision.NS).to_line_protocol()
+        )
+    return lines
+
+
+def stop_writers():
+    for writer in list(_writers.values()):
+        writer.stop()
+
+
+def _reset_after_fork():
+    global _lock
+    _lock = threading.Lock()
+    _writers.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(stop_writers)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import asyncio
+import atexit
+import logging
+import os
+import threading
+
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+
+from project.tools.client_pool import client_key
+from project.tools.influxdb_funcs import mk_ifdb_ts, mk_query
+
+logger = logging.getLogger("defaultLogger")
+
+ASYNC_CONCURRENCY = int(os.getenv("IFDB_ASYNC_CONCURRENCY", 8))
+
+# the async clients and their aiohttp sessions are bound to an event loop, so
+# every read of the process runs on one loop in a background thread and the
+# clients are pooled on it like the sync ones in client_pool
+_lock = threading.Lock()
+_loop = None
+_clients = {}
+
+
+def get_loop():
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="ifdb-async", daemon=True
+            ).start()
+    return _loop
+
+
+def get_async_client(ifdb_dict):
+    """Pooled InfluxDBClientAsync, only to be used on the loop of get_loop()."""
+    key = client_key(ifdb_dict)
+    client = _clients.get(key)
+    if client is None:
+        logger.debug(f"Creating pooled async client for {key[0]}.")
+        client = InfluxDBClientAsync(
+            url=key[0],
+            org=key[1],
+            token=key[2],
+            timeout=ifdb_dict.get("timeout"),
+        )
+        _clients[key] = client
+    return client
+
+
+async def async_read(
+    client,
+    ifdb_dict,
+    meas_dict,
+    start_ts=None,
+    stop_ts=None,
+    arr=None,
+    raise_errors=False,
+):
+    """Async version of just_read, takes an InfluxDBClientAsync."""
+    bucket = ifdb_dict.get("bucket")
+    measurement = meas_dict.get("measurement")
+    fields = list(meas_dict.get("fields").split(","))
+    start = mk_ifdb_ts(start_ts) if start_ts is not None else 0
+    stop = mk_ifdb_ts(stop_ts) if stop_ts is not None else "now()"
+
+    query = mk_query(bucket, start, stop, measurement, fields, arr)
+    try:
+        df = await client.query_api().query_data_frame(query)
+    except Exception as e:
+        if raise_errors:
+            raise
+        logger.debug(e)
+        logger.info(f"No data with query:\n {query}")
+        return None
+    # several tables come back as a list of frames, which is not supported
+    if isinstance(df, list) or df.empty:
+        logger.info(f"No data with query:\n {query}")
+        return None
+    return df[["_time"] + fields].rename(columns={"_time": "datetime"})
+
+
+async def async_read_many(
+    ifdb_dict, meas_dict, requests, limit=ASYNC_CONCURRENCY, raise_errors=False
+):
+    """
+    Run many reads of the same measurement concurrently.
+
+    args:
+    ---
+    requests -- list of tuples
+        (start_ts, stop_ts) or (start_ts, stop_ts, arr) for each read
+    limit -- int
+        how many queries can be running at the same time
+    raise_errors -- bool
+        return the exception of a failed query in its place instead of None
+
+    returns:
+    ---
+    list of dataframes (or None) in the order of requests
+    """
+    semaphore = asyncio.Semaphore(limit)
+    client = get_async_client(ifdb_dict)
+
+    async def one(request):
+        async with semaphore:
+            return await async_read(
+                client, ifdb_dict, meas_dict, *request, raise_errors=raise_errors
+            )
+
+    return await asyncio.gather(
+        *(one(request) for request in requests), return_exceptions=raise_errors
+    )
+
+
+def read_many(
+    ifdb_dict, meas_dict, requests, limit=ASYNC_CONCURRENCY, raise_errors=False
+):
+    """
+    Blocking wrapper of async_read_many for the flask and dash callbacks.
+
+    The wall clock time is about that of the slowest single query instead of
+    the sum of all of them.
+    """
+    if not requests:
+        return []
+    logger.debug(f"Running {len(requests)} queries, {limit} at a time.")
+    coro = async_read_many(ifdb_dict, meas_dict, requests, limit, raise_errors)
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+
+async def _close_clients():
+    for client in _clients.values():
+        try:
+            await client.close()
+        except Exception as e:
+            logger.debug(e)
+    _clients.clear()
+
+
+def close_async_clients():
+    """Close every pooled async client, used on shutdown."""
+    if _loop is not None and _loop.is_running():
+        asyncio.run_coroutine_threadsafe(_close_clients(), _loop).result(timeout=5)
+
+
+def _reset_after_fork():
+    # the loop thread doesn't exist in the child and the sessions belong to
+    # the parent
+    global _lock, _loop
+    _lock = threading.Lock()
+    _loop = None
+    _clients.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(close_async_clients)
@@ -1,26 +1,23 @@
 #!/usr/bin/env python3
 
-import influxdb_client as ifdb
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client import Dialect
 import logging
 import pandas as pd
 import numpy as np
 from urllib3.exceptions import NewConnectionError
+from project.tools.client_pool import get_query_api
+from project.tools.ifdb_writer import get_writer
+from project.tools.line_protocol import df_to_line_chunks
+from project.tools.query_cache import normalize_query, query_cache
 from project.tools.time_funcs import (
     convert_timestamp_format,
 )
 
 logger = logging.getLogger("defaultLogger")
 
-
-def init_client(ifdb_dict):
-    url = ifdb_dict.get("url")
-    token = ifdb_dict.get("token")
-    org = ifdb_dict.get("organization")
-    timeout = ifdb_dict.get("timeout")
-
-    client = ifdb.InfluxDBClient(url=url, token=token, org=org, timeout=timeout)
-    return client
+# plain csv without the annotation rows, only the header of each table
+STREAM_DIALECT = Dialect(header=True, annotations=[], date_time_format="RFC3339Nano")
+STREAM_CHUNK = 8192
 
 
 def mk_field_q(field_list):
@@ -43,34 +40,100 @@ def mk_meas_q(measurement):
     return f'\t|> filter(fn: (r) => r["_measurement"] == "{measurement}")\n'
 
 
-def mk_query(bucket, start, stop, measurement, fields, array_filter=None):
+def mk_window_q(every, fn):
+    return (
+        f"\t|> aggregateWindow(every: {every}, fn: {fn}, "
+        'createEmpty: false, timeSrc: "_start")\n'
+    )
+
+
+def mk_suffix_q(suffix):
+    return f'\t|> map(fn: (r) => ({{r with _field: r._field + "{suffix}"}}))\n'
+
+
+def mk_pivot_q():
+    return '\t|> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")'
+
+
+def mk_query(
+    bucket,
+    start,
+    stop,
+    measurement,
+    fields,
+    array_filter=None,
+    every=None,
+    envelope=False,
+):
+    """
+    Create a pivoted flux query.
+
+    args:
+    ---
+    every -- str or None
+        aggregateWindow duration, eg. "10s". None returns the raw points.
+    envelope -- bool
+        with every, also return <field>_min and <field>_max columns next to
+        the window means
+    """
+    arr_q = ""
+    tag_q = ""
     if array_filter:
         # arr = array_filter["arr"]
         arr = str(array_filter["arr"]).replace("'", '"')
         tag = array_filter["tag"]
+        arr_q = f"arr = {arr}\n"
+        tag_q = f'\t|> filter(fn: (r) => contains(value: r["{tag}"], set: arr))\n'
 
-        query = (
-            f"arr = {arr}\n"
-            f"{mk_bucket_q(bucket)}"
-            f"{mk_range_q(start, stop)}"
-            f"{mk_meas_q(measurement)}"
-            f"{mk_field_q(fields)}"
-            f'\t|> filter(fn: (r) => contains(value: r["{tag}"], set: arr))\n'
-            '\t|> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")'
-        )
-        pass
-    else:
-        query = (
-            f"{mk_bucket_q(bucket)}"
-            f"{mk_range_q(start, stop)}"
-            f"{mk_meas_q(measurement)}"
-            f"{mk_field_q(fields)}"
-            '\t|> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")'
-        )
+    source = (
+        f"{mk_bucket_q(bucket)}"
+        f"{mk_range_q(start, stop)}"
+        f"{mk_meas_q(measurement)}"
+        f"{mk_field_q(fields)}"
+        f"{tag_q}"
+    )
 
+    if every is None:
+        return f"{arr_q}{source}{mk_pivot_q()}"
+    if not envelope:
+        return f"{arr_q}{source}{mk_window_q(every, 'mean')}{mk_pivot_q()}"
+    query = (
+        f"{arr_q}"
+        f"data = {source}"
+        "union(tables: [\n"
+        f"data\n{mk_window_q(every, 'mean')},\n"
+        f"data\n{mk_window_q(every, 'min')}{mk_suffix_q('_min')},\n"
+        f"data\n{mk_window_q(every, 'max')}{mk_suffix_q('_max')},\n"
+        "])\n"
+        f"{mk_pivot_q()}"
+    )
     return query
 
 
+# aggregation windows that can be picked for a point budget
+WINDOW_STEPS_S = [1, 2, 5, 10, 15, 30, 60, 120, 300, 600, 900, 1800, 3600, 21600]
+
+
+def pick_window(start_ts, stop_ts, max_points):
+    """
+    Pick the aggregateWindow duration that keeps a 1 Hz series between
+    start_ts and stop_ts under max_points points.
+
+    returns:
+    ---
+    str duration for mk_query, None when the raw points fit in the budget
+    """
+    if not max_points or start_ts is None or stop_ts is None:
+        return None
+    needed = (stop_ts - start_ts).total_seconds() / max_points
+    if needed <= 1:
+        return None
+    for step in WINDOW_STEPS_S:
+        if step >= needed:
+            return f"{step}s"
+    return f"{int(np.ceil(needed))}s"
+
+
 def mk_oldest_ts_q(bucket, measurement, fields):
     query = (
         f"{mk_bucket_q(bucket)}"
@@ -99,7 +162,27 @@ def mk_ifdb_ts(ts):
     return ts.strftime("%Y-%m-%dT%H:%M:%SZ")
 
 
-def read_ifdb(ifdb_dict, meas_dict, start_ts=None, stop_ts=None, arr=None):
+def read_ifdb(
+    ifdb_dict,
+    meas_dict,
+    start_ts=None,
+    stop_ts=None,
+    arr=None,
+    stream=False,
+    max_points=None,
+    envelope=False,
+    cache=True,
+):
+    """
+    Query a measurement from InfluxDB with the pooled client.
+
+    With max_points, long ranges are aggregated in the database with
+    aggregateWindow so that about max_points rows are returned. envelope adds
+    the window minimum and maximum as <field>_min and <field>_max.
+
+    Results are kept in the query cache for QUERY_CACHE_TTL_S and identical
+    concurrent queries only run once, pass cache=False to always query.
+    """
     bucket = ifdb_dict.get("bucket")
     measurement = meas_dict.get("measurement")
     fields = list(meas_dict.get("fields").split(","))
@@ -117,12 +200,22 @@ def read_ifdb(ifdb_dict, meas_dict, start_ts=None, stop_ts=None, arr=None):
     else:
         stop = "now()"
 
-    with init_client(ifdb_dict) as client:
-        q_api = client.query_api()
-        query = mk_query(bucket, start, stop, measurement, fields, arr)
-        # logger.debug(query)
+    columns = fields
+    every = pick_window(start_ts, stop_ts, max_points)
+    if every is not None:
+        logger.debug(f"Aggregating to {every} windows.")
+        if envelope:
+            columns = fields + [f"{f}_{s}" for s in ("min", "max") for f in fields]
+
+    q_api = get_query_api(ifdb_dict)
+    query = mk_query(bucket, start, stop, measurement, fields, arr, every, envelope)
+    # logger.debug(query)
+
+    def load():
+        if stream:
+            return stream_read(q_api, query, columns)
         try:
-            df = q_api.query_data_frame(query)[["_time"] + fields]
+            df = q_api.query_data_frame(query)[["_time"] + columns]
         except Exception:
             logger.info(f"No data with query:\n {query}")
             return None
@@ -133,8 +226,32 @@ def read_ifdb(ifdb_dict, meas_dict, start_ts=None, stop_ts=None, arr=None):
             logger.debug(f"diagsum: {df['DIAG'].sum()}")
         return df
 
-
-def just_read(ifdb_dict, meas_dict, client, start_ts=None, stop_ts=None, arr=None):
+    if not cache:
+        return load()
+    key = (
+        ifdb_dict.get("url"),
+        ifdb_dict.get("organization"),
+        normalize_query(query),
+        stream,
+    )
+    return query_cache.get_or_load(key, load)
+
+
+def just_read(
+    ifdb_dict,
+    meas_dict,
+    client,
+    start_ts=None,
+    stop_ts=None,
+    arr=None,
+    stream=False,
+    raise_errors=False,
+):
+    """
+    Query a measurement with the given client, None if there is no data or
+    the query fails. With raise_errors a failing query raises instead, so
+    that None only means no data.
+    """
     logger.debug(f"Running query from {start_ts} to {stop_ts}")
 
     bucket = ifdb_dict.get("bucket")
@@ -154,50 +271,132 @@ def just_read(ifdb_dict, meas_dict, client, start_ts=None, stop_ts=None, arr=Non
     q_api = client.query_api()
     query = mk_query(bucket, start, stop, measurement, fields, arr)
     logger.debug(query)
+    if stream:
+        return stream_read(q_api, query, fields, raise_errors)
     try:
-        df = q_api.query_data_frame(query)[["_time"] + fields]
+        df = q_api.query_data_frame(query)
     except Exception as e:
+        if raise_errors:
+            raise
         logger.debug(e)
         logger.info(f"No data with query:\n {query}")
         return None
+    # several tables come back as a list of frames, which is not supported
+    if isinstance(df, list) or df.empty:
+        logger.info(f"No data with query:\n {query}")
+        return None
 
-    df = df.rename(columns={"_time": "datetime"})
+    df = df[["_time"] + fields].rename(columns={"_time": "datetime"})
     return df
 
 
-def ifdb_push(df, client, ifdb_dict, tag_columns):
+def stream_read(q_api, query, fields, raise_errors=False):
+    """
+    Run a pivoted query and parse the csv response as it streams in.
+
+    _time is decoded straight into int64 nanoseconds and each field into a
+    float array, the other columns of the response are never materialized.
+    Only works for numeric fields.
+
+    args:
+    ---
+    q_api -- influxdb_client.QueryApi
+    query -- str
+        flux query, from mk_query
+    fields -- list
+        fields to read from the pivoted result
+    raise_errors -- bool
+        raise if the query fails instead of returning None
+
+    returns:
+    ---
+    pandas.DataFrame with datetime and field columns, None if there was no
+    data.
+    """
+    try:
+        rows = q_api.query_csv(query, dialect=STREAM_DIALECT)
+        times, values = parse_csv_stream(rows, fields)
+    except Exception as e:
+        if raise_errors:
+            raise
+        logger.debug(e)
+        logger.info(f"No data with query:\n {query}")
+        return None
+
+    if len(times) == 0:
+        logger.info(f"No data with query:\n {query}")
+        return None
+    df = pd.DataFrame(values)
+    df.insert(0, "datetime", pd.to_datetime(times, unit="ns", utc=True))
+    return df
+
+
+def parse_csv_stream(rows, fields, chunk=STREAM_CHUNK):
+    size = chunk
+    n = 0
+    times = np.empty(size, dtype=np.int64)
+    values = {f: np.empty(size, dtype=np.float64) for f in fields}
+    t_buf = []
+    v_buf = []
+    cols = None
+
+    def flush():
+        nonlocal size, times, values, n
+        if not t_buf:
+            return
+        m = len(t_buf)
+        while n + m > size:
+            size *= 2
+            times = np.resize(times, size)
+            values = {f: np.resize(a, size) for f, a in values.items()}
+        # RFC3339 with the Z stripped parses directly to datetime64
+        times[n : n + m] = np.array(t_buf, dtype="datetime64[ns]").view(np.int64)
+        block = np.array(v_buf, dtype=np.float64).reshape(m, len(fields))
+        for i, f in enumerate(fields):
+            values[f][n : n + m] = block[:, i]
+        n += m
+        t_buf.clear()
+        v_buf.clear()
+
+    for row in rows:
+        if not row or not any(row):
+            # empty line separates tables, next one is a header
+            cols = None
+            continue
+        if cols is None:
+            cols = [row.index("_time")] + [row.index(f) for f in fields]
+            continue
+        t_buf.append(row[cols[0]].rstrip("Z"))
+        v_buf.extend(row[c] or "nan" for c in cols[1:])
+        if len(t_buf) >= chunk:
+            flush()
+    flush()
+    return times[:n], {f: a[:n] for f, a in values.items()}
+
+
+def ifdb_push(df, ifdb_dict, tag_columns):
     """
     Push data to InfluxDB
 
+    The data is serialized to line protocol in chunks and handed to the
+    background writer of the bucket, this returns as soon as it is queued.
+
     args:
     ---
     df -- pandas dataframe
         data to be pushed into influxdb
+    tag_columns -- list
+        columns written as tags, the rest are fields
 
     returns:
     ---
 
     """
-    logger.debug("Attempting push.")
-    bucket = ifdb_dict.get("bucket")
     measurement_name = ifdb_dict.get("measurement")
-
-    write_api = client.write_api(write_options=SYNCHRONOUS)
-    dc = ifdb_dict
-    print(f"Writing {dc.get('measurement')} to {dc.get('url')} {dc.get('bucket')}")
-    print("data:")
-    print(df.head())
-    print(df.tail())
-    print(df.tz_convert("Europe/Helsinki"))
-    try:
-        write_api.write(
-            bucket=bucket,
-            record=df,
-            data_frame_measurement_name=measurement_name,
-            # NOTE: figure out a good way of handling tag cols
-            data_frame_tag_columns=tag_columns,
-            debug=True,
-        )
-    except Exception as e:
-        print(e)
-        print("No pushing")
+    logger.debug(
+        f"Pushing {len(df)} rows of {measurement_name} to "
+        f"{ifdb_dict.get('url')} {ifdb_dict.get('bucket')}."
+    )
+    writer = get_writer(ifdb_dict)
+    for lines in df_to_line_chunks(df, measurement_name, tag_columns):
+        writer.submit(lines)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+import pandas as pd
+
+from project.tools.client_pool import get_client
+from project.tools.influxdb_async import read_many
+from project.tools.influxdb_funcs import just_read
+
+logger = logging.getLogger("defaultLogger")
+
+CACHE_DIR = os.getenv("LICOR_CACHE_DIR", "cache/licor")
+CACHE_MAX_BYTES = int(os.getenv("LICOR_CACHE_MAX_BYTES", 2 * 1024**3))
+# the logger pushes with a delay, anything newer than this is not trusted to be
+# complete and is always queried again
+SETTLE_TIME = pd.Timedelta(minutes=int(os.getenv("LICOR_CACHE_SETTLE_MIN", 15)))
+# how often the access times of read-only hits are written to the manifest
+ATIME_FLUSH_S = 60
+
+DAY_NS = 86400 * 10**9
+
+
+def subtract_ranges(want, covered):
+    """Return the parts of the [start, stop) range want not in covered."""
+    start, stop = want
+    gaps = []
+    for c_start, c_stop in sorted(covered):
+        if c_stop <= start:
+            continue
+        if c_start >= stop:
+            break
+        if c_start > start:
+            gaps.append((start, c_start))
+        start = max(start, c_stop)
+        if start >= stop:
+            break
+    if start < stop:
+        gaps.append((start, stop))
+    return gaps
+
+
+def merge_ranges(ranges):
+    """Merge overlapping and touching [start, stop) ranges."""
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return merged
+
+
+class LicorCache:
+    """
+    Read-through cache of raw LI-COR data stored as one Parquet file per UTC
+    day.
+
+    manifest.json keeps the time ranges each day file covers, its size and
+    when it was last used. Only the parts of a request that are not covered
+    are queried from InfluxDB, so a day that is complete is never queried
+    again. When the files grow over max_bytes the least recently used days
+    are removed.
+
+    The directory can be shared by several processes, changes to the
+    manifest are done under a file lock.
+    """
+
+    def __init__(self, root=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.manifest_path = os.path.join(root, "manifest.json")
+        self.lock_path = os.path.join(root, "manifest.lock")
+        self._lock = threading.Lock()
+        self._atime_flushed = 0
+        self._mtime = None
+        os.makedirs(root, exist_ok=True)
+        self.manifest = self._load_manifest()
+
+    def read(self, ifdb_dict, meas_dict, client=None, start_ts=None, stop_ts=None):
+        """
+        Same as just_read but served from the cache where possible.
+
+        returns:
+        ---
+        pandas.DataFrame with a datetime column and the fields, None if there
+        is no data
+        """
+        if start_ts is None or stop_ts is None:
+            return just_read(
+                ifdb_dict, meas_dict, client or get_client(ifdb_dict), start_ts, stop_ts
+            )
+        start = pd.Timestamp(start_ts).value
+        stop = pd.Timestamp(stop_ts).value
+        self._refresh()
+        settled = (pd.Timestamp.now(tz="UTC") - SETTLE_TIME).value
+
+        for g_start, g_stop in self._gaps([(start, stop)]):
+            self._fetch(ifdb_dict, meas_dict, client, g_start, g_stop, settled)
+
+        frames = []
+        for day in self._days(start, stop):
+            df = self._read_day(day)
+            if df is None:
+                continue
+            lo = df.index.searchsorted(pd.Timestamp(start, tz="UTC"), side="left")
+            hi = df.index.searchsorted(pd.Timestamp(stop, tz="UTC"), side="left")
+            frames.append(df.iloc[lo:hi])
+        self._touch()
+        if not frames:
+            return None
+        df = pd.concat(frames)
+        if df.empty:
+            return None
+        fields = list(meas_dict.get("fields").split(","))
+        return df[fields].reset_index()
+
+    def warm(self, ifdb_dict, meas_dict, ranges):
+        """
+        Fetch the uncovered parts of many (start_ts, stop_ts) ranges with
+        concurrent queries, so that the reads that follow are cache hits.
+        """
+        ranges = [(pd.Timestamp(s).value, pd.Timestamp(e).value) for s, e in ranges]
+        self._refresh()
+        settled = (pd.Timestamp.now(tz="UTC") - SETTLE_TIME).value
+        gaps = self._gaps(ranges)
+        requests = [
+            (pd.Timestamp(s, tz="UTC"), pd.Timestamp(e, tz="UTC")) for s, e in gaps
+        ]
+        results = read_many(ifdb_dict, meas_dict, requests, raise_errors=True)
+        for (start, stop), df in zip(gaps, results):
+            if isinstance(df, Exception):
+                logger.warning(f"Warming the cache failed: {df}")
+                continue
+            self._store(df, start, stop, settled)
+
+    def _gaps(self, ranges):
+        gaps = []
+        for start, stop in merge_ranges(ranges):
+            for day in self._days(start, stop):
+                covered = self.manifest["days"].get(day, {}).get("ranges", [])
+                d_start = day_start(day)
+                want = (max(start, d_start), min(stop, d_start + DAY_NS))
+                gaps.extend(subtract_ranges(want, covered))
+        return merge_ranges(gaps)
+
+    def _fetch(self, ifdb_dict, meas_dict, client, start, stop, settled):
+        client = client or get_client(ifdb_dict)
+        logger.debug(f"Cache miss {pd.Timestamp(start)} to {pd.Timestamp(stop)}.")
+        try:
+            df = just_read(
+                ifdb_dict,
+                meas_dict,
+                client,
+                start_ts=pd.Timestamp(start, tz="UTC"),
+                stop_ts=pd.Timestamp(stop, tz="UTC"),
+                stream=True,
+                raise_errors=True,
+            )
+        except Exception as e:
+            # not covered, tried again next time
+            logger.warning(f"Reading LI-COR data failed: {e}")
+            return
+        self._store(df, start, stop, settled)
+
+    def _store(self, df, start, stop, settled):
+        """
+        Write the rows of a fetched range to the day files and mark the
+        settled part of the range covered. df is None when the range has no
+        data, eg. the logger was down, which covers it all the same.
+        """
+        if df is None:
+            df = pd.DataFrame(index=pd.DatetimeIndex([], tz="UTC"))
+        else:
+            df = df.set_index("datetime")
+            df.index = pd.to_datetime(df.index, utc=True)
+
+        with self._file_lock():
+            self.manifest = self._load_manifest()
+            for day in self._days(start, stop):
+                d_start = day_start(day)
+                lo = df.index.searchsorted(pd.Timestamp(d_start, tz="UTC"))
+                hi = df.index.searchsorted(pd.Timestamp(d_start + DAY_NS, tz="UTC"))
+                self._write_day(day, df.iloc[lo:hi])
+                # only the part that can't change anymore counts as covered
+                c_stop = min(stop, d_start + DAY_NS, settled)
+                c_start = max(start, d_start)
+                entry = self.manifest["days"].setdefault(
+                    day, {"ranges": [], "bytes": 0, "atime": 0}
+                )
+                if c_start < c_stop:
+                    entry["ranges"] = merge_ranges(
+                        entry["ranges"] + [[c_start, c_stop]]
+                    )
+                entry["bytes"] = self._size(day)
+                entry["atime"] = time.time()
+            self._evict()
+            self._save_manifest()
+
+    def _write_day(self, day, df):
+        if df.empty:
+            return
+        old = self._read_day(day)
+        if old is not None:
+            df = pd.concat([old, df])
+            df = df[~df.index.duplicated(keep="last")].sort_index()
+        path = self._path(day)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        df.to_parquet(tmp)
+        os.replace(tmp, path)
+
+    def _read_day(self, day):
+        path = self._path(day)
+        if not os.path.exists(path):
+            return None
+        self.manifest["days"].get(day, {})["atime"] = time.time()
+        return pd.read_parquet(path)
+
+    def _evict(self):
+        days = self.manifest["days"]
+        total = sum(entry["bytes"] for entry in days.values())
+        for day in sorted(days, key=lambda d: days[d]["atime"]):
+            if total <= self.max_bytes:
+                break
+            logger.debug(f"Evicting {day} from cache.")
+            total -= days[day]["bytes"]
+            del days[day]
+            try:
+                os.remove(self._path(day))
+            except FileNotFoundError:
+                pass
+
+    def _touch(self):
+        # access times of pure hits are only persisted every now and then
+        if time.time() - self._atime_flushed < ATIME_FLUSH_S:
+            return
+        with self._file_lock():
+            atimes = {d: e["atime"] for d, e in self.manifest["days"].items()}
+            self.manifest = self._load_manifest()
+            for day, atime in atimes.items():
+                entry = self.manifest["days"].get(day)
+                if entry is not None:
+                    entry["atime"] = max(entry["atime"], atime)
+            self._save_manifest()
+
+    def _days(self, start, stop):
+        first = start - start % DAY_NS
+        return [
+            pd.Timestamp(ns).strftime("%Y-%m-%d") for ns in range(first, stop, DAY_NS)
+        ]
+
+    def _path(self, day):
+        return os.path.join(self.root, f"{day}.parquet")
+
+    def _size(self, day):
+        try:
+            return os.path.getsize(self._path(day))
+        except FileNotFoundError:
+            return 0
+
+    def _refresh(self):
+        # pick up days written by other workers
+        try:
+            mtime = os.path.getmtime(self.manifest_path)
+        except FileNotFoundError:
+            return
+        if mtime != self._mtime:
+            self.manifest = self._load_manifest()
+
+    def _load_manifest(self):
+        try:
+            self._mtime = os.path.getmtime(self.manifest_path)
+            with open(self.manifest_path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"days": {}}
+
+    def _save_manifest(self):
+        tmp = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp, self.manifest_path)
+        self._atime_flushed = time.time()
+
+    def _file_lock(self):
+        return _FileLock(self.lock_path, self._lock)
+
+
+class _FileLock:
+    def __init__(self, path, thread_lock):
+        self.path = path
+        self.thread_lock = thread_lock
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        self.f = open(self.path, "a")
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+        self.thread_lock.release()
+
+
+def day_start(day):
+    return pd.Timestamp(day, tz="UTC").value
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(ifdb_dict):
+    """Return the cache for the bucket in ifdb_dict, one directory per bucket."""
+    bucket = ifdb_dict.get("bucket")
+    with _caches_lock:
+        cache = _caches.get(bucket)
+        if cache is None:
+            cache = LicorCache(os.path.join(CACHE_DIR, bucket))
+            _caches[bucket] = cache
+    return cache
+
+
+def cached_read(ifdb_dict, meas_dict, client=None, start_ts=None, stop_ts=None):
+    return get_cache(ifdb_dict).read(ifdb_dict, meas_dict, client, start_ts, stop_ts)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import (
+    is_bool_dtype,
+    is_float_dtype,
+    is_integer_dtype,
+)
+
+LINE_CHUNK = 50000
+
+
+def escape_measurement(name):
+    return name.replace(",", r"\,").replace(" ", r"\ ")
+
+
+def escape_key(name):
+    return name.replace(",", r"\,").replace("=", r"\=").replace(" ", r"\ ")
+
+
+def escape_tag_values(s):
+    return (
+        s.astype(str)
+        .str.replace(",", r"\,", regex=False)
+        .str.replace("=", r"\=", regex=False)
+        .str.replace(" ", r"\ ", regex=False)
+    )
+
+
+def format_field(name, s):
+    """
+    Format one column as key=value field strings, missing values become "".
+    """
+    key = escape_key(name)
+    if is_bool_dtype(s):
+        values = np.where(s.to_numpy(), "true", "false").astype(object)
+        missing = np.zeros(len(s), dtype=bool)
+    elif is_integer_dtype(s):
+        missing = s.isna().to_numpy()
+        values = s.astype(str).to_numpy().astype(object) + "i"
+    elif is_float_dtype(s):
+        arr = s.to_numpy(dtype=np.float64)
+        missing = ~np.isfinite(arr)
+        # numpy gives the shortest repr that round-trips
+        values = arr.astype(str).astype(object)
+    else:
+        missing = s.isna().to_numpy()
+        escaped = (
+            s.astype(str)
+            .str.replace("\\", "\\\\", regex=False)
+            .str.replace('"', '\\"', regex=False)
+        )
+        values = ('"' + escaped + '"').to_numpy()
+    return np.where(missing, "", key + "=" + values)
+
+
+def df_to_line_chunks(df, measurement, tag_columns=None, chunk_size=LINE_CHUNK):
+    """
+    Serialize a dataframe to line protocol in chunks.
+
+    The index is the timestamp (written in ns, naive times are taken as UTC),
+    tag_columns are written as tags and every other column as a field typed
+    after its dtype. Each chunk is built with whole-column string operations.
+    Rows where every field is missing are dropped.
+
+    args:
+    ---
+    df -- pandas.DataFrame
+        data with a DatetimeIndex
+    measurement -- str
+    tag_columns -- list
+    chunk_size -- int
+        rows per yielded chunk
+
+    yields:
+    ---
+    list of line protocol strings
+    """
+    tag_columns = sorted(tag_columns or [])
+    field_columns = [c for c in df.columns if c not in tag_columns]
+    index = pd.DatetimeIndex(df.index)
+    if index.tz is not None:
+        index = index.tz_convert("UTC")
+    ts = index.as_unit("ns").asi8.astype(str).astype(object)
+    measurement = escape_measurement(measurement)
+
+    for start in range(0, len(df), chunk_size):
+        part = df.iloc[start : start + chunk_size]
+        head = np.full(len(part), measurement, dtype=object)
+        for tag in tag_columns:
+            values = part[tag]
+            present = (values.notna() & (values.astype(str) != "")).to_numpy()
+            pieces = "," + escape_key(tag) + "=" + escape_tag_values(values).to_numpy()
+            head = head + np.where(present, pieces, "")
+
+        fields = np.full(len(part), "", dtype=object)
+        for column in field_columns:
+            piece = format_field(column, part[column])
+            sep = np.where((fields != "") & (piece != ""), ",", "")
+            fields = fields + sep + piece
+
+        lines = head + " " + fields + " " + ts[start : start + chunk_size]
+        yield lines[fields != ""].tolist()
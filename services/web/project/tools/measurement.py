@@ -1,12 +1,32 @@
+import threading
+
+import numpy as np
 import pandas as pd
-from collections import namedtuple
-from project.tools.influxdb_funcs import just_read, read_ifdb
-from project.tools.gas_funcs import calculate_pearsons_r
+from project.tools.licor_cache import cached_read, get_cache
+from project.tools.gas_funcs import (
+    LAG_SHIFTS_S,
+    PrefixSums,
+    calculate_pearsons_r,
+    pick_lag,
+    sliding_pearsons_r,
+    window_argmax,
+)
 from project.tools.filter import get_datetime_index
+from project.tools.cycle_matrix import CycleMatrix
+from project.tools.quality import evaluate_rules, failed_rules
 import logging
 
 logger = logging.getLogger("defaultLogger")
 
+LICOR_MEAS = {"measurement": "AC LICOR", "fields": "CH4,CO2,DIAG"}
+
+
+def to_utc(ts, tz="Europe/Helsinki"):
+    """Naive timestamps are local time, aware ones are only converted."""
+    if ts.tzinfo is None:
+        ts = ts.tz_localize(tz)
+    return ts.tz_convert("UTC")
+
 
 class MeasurementCycle:
     def __init__(self, id, start, close, open, end, data=None):
@@ -16,10 +36,10 @@ class MeasurementCycle:
         self.close_offset = 240
         self.open_offset = 720
         # self.og_start = start.tz_localize("Europe/Helsinki").tz_convert("UTC")
-        self.start = start.tz_localize("Europe/Helsinki").tz_convert("UTC")
+        self.start = to_utc(start)
         self.og_open = self.start + pd.Timedelta(seconds=self.open_offset)
         self.og_close = self.start + pd.Timedelta(seconds=self.close_offset)
-        self.end = end.tz_localize("Europe/Helsinki").tz_convert("UTC")
+        self.end = to_utc(end)
         self.lag_end = self.open + pd.Timedelta(seconds=120)
         self.data = data
         self.calc_data = None
@@ -27,6 +47,7 @@ class MeasurementCycle:
         self.lagtime_s = 0
         self.is_valid = True
         self.no_data_in_db = False
+        self.is_ready = False
         self.has_errors = False
         self.adjusted_time = False
         self.manual_valid = None
@@ -34,6 +55,14 @@ class MeasurementCycle:
         self.co2_r_offset = 0
         self.ch4_r = 0
         self.co2_r = 0
+        self.r_curves = {}
+        self.prefix_sums = {}
+        self.met = None
+        self.failed_rules = []
+        # when the results were last saved to or read from the results store
+        self.stored_at = None
+        # held while the data is loaded, by callbacks and the prefetcher
+        self._load_lock = threading.RLock()
 
     @property
     def close(self):
@@ -66,71 +95,62 @@ class MeasurementCycle:
         self.open_offset = self.og_open_offset
 
     def just_get_data(self, ifdb_dict, client):
-        if self.data is None:
-            # tz = "Europe/Helsinki"
-            meas_dict = {"measurement": "AC LICOR", "fields": "CH4,CO2,DIAG"}
-            self.data = just_read(
-                ifdb_dict, meas_dict, client, start_ts=self.start, stop_ts=self.end
-            )
-            if self.data is None:
-                self.is_valid = False
-                self.no_data_in_db = True
-                return
-            if self.data.empty:
-                self.is_valid = False
-                return
-            self.data.set_index("datetime", inplace=True)
-            self.data.index = pd.to_datetime(self.data.index)
-            start, end = get_datetime_index(
-                self.data, self, s_key="close", e_key="open"
-            )
-            self.calc_data = self.data.iloc[start:end].copy()
-            if self.calc_data["DIAG"].sum() != 0:
-                self.has_errors = True
-            self.get_max()
-
-    def get_data(self, ifdb_dict):
-        if self.data is None:
-            meas_dict = {"measurement": "AC LICOR", "fields": "CH4,CO2,DIAG"}
-            self.data = read_ifdb(
-                ifdb_dict, meas_dict, start_ts=self.start, stop_ts=self.end
-            )
-            if self.data is None:
+        self.get_data(ifdb_dict, client)
+
+    def set_data(self, data):
+        """
+        Attach already queried data to the cycle and run the calculations.
+
+        The results are calculated from data before it is set, so that a
+        cycle with data always has its lag, r and validity too.
+
+        args:
+        ---
+        data -- pandas.DataFrame or None
+            CH4, CO2 and DIAG with a datetime index, None if the query failed
+        """
+        with self._load_lock:
+            self.prefix_sums = {}
+            if data is None:
                 self.is_valid = False
                 self.no_data_in_db = True
-                return
-            if self.data.empty:
-                self.is_valid = False
-                return
-            self.data.index = pd.to_datetime(self.data["datetime"])
-
-            # print(self.data.resample("1m").mean())
-            # print(self.data.datetime)
-            # print(self.data)
-            if (
-                self.data["CH4"].resample("20s").mean().is_monotonic_decreasing
-                or self.data["CH4"].resample("20s").mean().is_monotonic_increasing
-            ):
+            elif data.empty:
                 self.is_valid = False
+            else:
+                start, end = get_datetime_index(data, self, s_key="close", e_key="open")
+                self.calc_data = data.iloc[start:end].copy()
+                self.get_max(data=data)
+            self.data = data
 
-            self.data.set_index("datetime", inplace=True)
-            start, end = get_datetime_index(
-                self.data, self, s_key="close", e_key="open"
+    def get_data(self, ifdb_dict, client=None):
+        """
+        Read the data of the cycle and run the calculations, unless another
+        thread already did. Blocks while another thread is loading it.
+        """
+        with self._load_lock:
+            if self.data is not None:
+                return
+            data = cached_read(
+                ifdb_dict, LICOR_MEAS, client, start_ts=self.start, stop_ts=self.end
             )
-            self.calc_data = self.data.iloc[start:end]
-            if self.calc_data["DIAG"].sum() != 0:
-                self.is_valid = False
-            self.get_max()
+            if data is not None and not data.empty:
+                data = data.set_index("datetime")
+                data.index = pd.to_datetime(data.index)
+            self.set_data(data)
 
-    def get_max(self, ifdb_dict=None):
+    def get_max(self, ifdb_dict=None, data=None):
+        if data is None:
+            if self.data is None:
+                # runs the calculations once the data is there
+                return self.get_data(ifdb_dict)
+            data = self.data
+        cycle_data = data
         data = None
-        if self.data is None:
-            self.get_data(ifdb_dict)
-        if self.data is not None and not self.data.empty:
+        if cycle_data is not None and not cycle_data.empty:
             start, end = get_datetime_index(
-                self.data, self, s_key="open", e_key="lag_end"
+                cycle_data, self, s_key="open", e_key="lag_end"
             )
-            data = self.data.iloc[start:end].copy()
+            data = cycle_data.iloc[start:end].copy()
         if data is None:
             self.is_valid = False
             # self.lagtime_index = None
@@ -143,57 +163,68 @@ class MeasurementCycle:
         # self.get_r()
         for gas in ["CH4", "CO2"]:
             self.get_max_r(gas)
-        if self.ch4_r < 0.6:
-            self.is_valid = False
-        self.get_lagtime(data)
+        self.get_lagtime(data, cycle_data)
+        self.check_quality(cycle_data)
 
-    def get_lag_df(self, start, end):
-        frame = namedtuple("filter", ["open", "lag_end"])
-        filter = frame(start, end)
+    def check_quality(self, data=None):
+        """
+        Evaluate QUALITY_RULES on the data of the cycle, the names of the
+        rules that failed are kept in failed_rules.
+        """
+        data = self.data if data is None else data
+        matrix = CycleMatrix.from_frame(data, [self.start.value], [self.id])
+        close = int(round(self.close_offset + self.lagtime_s))
+        failed = evaluate_rules(matrix, close, self.open_offset, [self.ch4_r])
+        self.failed_rules = failed_rules(failed)[0]
+        self.has_errors = "diag" in self.failed_rules
+        self.is_valid = not self.failed_rules
 
-        start, end = get_datetime_index(
-            self.data, filter, s_key="open", e_key="lag_end"
-        )
-        data = self.data.iloc[start:end].copy()
-        return data
+    def get_lagtime(self, data, cycle_data=None):
+        """
+        Find the lag from the maximum of CH4 after open.
 
-    def get_lagtime(self, data):
+        The maxima of data and of the moved back windows are all found from
+        one array, the data of the whole cycle, and the lag is chosen from
+        them with pick_lag.
+        """
+        cycle_data = self.data if cycle_data is None else cycle_data
         if self.got_lag is True:
             return
         self.got_lag = True
         self.lagtime_s = 0
         self.open_offset = self.og_open_offset
-        lagtime_idx = data["CH4"].idxmax()
-        lagtime_idx = self.find_negative_lagtime(data, lagtime_idx)
-        # if (lagtime_idx - open).total_seconds() == 119:
-        if (lagtime_idx - self.open).total_seconds() >= 100:
-            logger.debug("Found max lag")
-            lagtime_idx = self.find_negative_lagtime(data, lagtime_idx, 10)
-
-        self.lagtime_s = (lagtime_idx - self.og_open).total_seconds()
+        open = self.og_open.value
+        shifts = np.array(LAG_SHIFTS_S, dtype=np.int64) * 10**9
+        starts = np.concatenate(([data.index[0].value], open - shifts))
+        ends = np.concatenate(([self.lag_end.value], self.lag_end.value - shifts))
+
+        t = cycle_data.index.asi8
+        idx = window_argmax(t, cycle_data["CH4"].to_numpy(dtype=float), starts, ends)
+        lags = np.where(idx >= 0, (t[idx] - open) / 1e9, np.nan)
+        self.lagtime_s = float(pick_lag(*lags))
         logger.debug(f"lag seconds: {self.lagtime_s}")
 
-    def find_negative_lagtime(self, data, lagtime_idx, back=0):
-        logger.debug("Trying to find negative lagtime")
-        i = 0
-        open = self.og_open
-        lag_end = self.lag_end
-        back = pd.Timedelta(seconds=back)
-        lag = (lagtime_idx - open).total_seconds()
-        logger.debug(lag)
-        while (lag == 0 and i < 12) or (lag >= 110 and i < 10):
-            logger.debug(lag)
-            i += 1
-            ten_s = pd.Timedelta(seconds=10) + back
-            start = open - ten_s
-            end = lag_end - ten_s
-            logger.debug(f"Find between {start} {end} ")
-            data = self.get_lag_df(start, end).copy()
-            lagtime_idx = data["CH4"].idxmax()
-            open = open - ten_s
-            lag_end = lag_end - ten_s
-
-        return lagtime_idx
+    def window_stats(self, gas, close_offset, open_offset):
+        """
+        Slope and r of gas between the given offsets from start, with the
+        lag time applied to close like close_t.
+
+        The prefix sums of the gas are made once per data, after that every
+        window is a constant amount of work.
+
+        returns:
+        ---
+        (n, slope, r), slope in units per second
+        """
+        if self.data is None or self.data.empty:
+            return 0, np.nan, np.nan
+        sums = self.prefix_sums.get(gas)
+        if sums is None:
+            sums = PrefixSums(self.data.index.asi8, self.data[gas].to_numpy(float))
+            self.prefix_sums[gas] = sums
+        start = self.start.value
+        close = start + int((close_offset + self.lagtime_s) * 10**9)
+        return sums.window(close, start + int(open_offset) * 10**9)
 
     def push_lagtimes(self, ifdb_dict):
         pass
@@ -203,38 +234,46 @@ class MeasurementCycle:
             self.calc_data.index.view(int), self.calc_data["CH4"]
         )
 
-    def get_max_r(self, gas):
-        max_r = None
-        max_r_idx = None
-        df = self.calc_data.copy()
-        interval = "3min"
-        interval_minutes = 3
-        increment_seconds = 20
-        interval_delta = pd.Timedelta(minutes=interval_minutes)
-        increment_delta = pd.Timedelta(seconds=increment_seconds)
-        start_time = df.index[0]
-        end_time = df.index[-1]
-        while start_time <= end_time:
-            # Define the interval end time
-            interval_end = start_time + interval_delta
-
-            # Select data within the interval
-            data = df[(df.index >= start_time) & (df.index < interval_end)]
-            if not data.empty:
-                # Apply the function to the data in the current interval
-                r = abs(calculate_pearsons_r(data.index.view(int), data[gas]))
-                logger.debug(r)
-            if len(data) > 180 * 0.9:
-                if max_r is None or r > max_r:
-                    max_r = r
-                    max_r_idx = start_time
-            start_time += increment_delta
-        logger.debug(max_r)
-        logger.debug(max_r_idx)
-        if max_r_idx is None:
-            max_r_idx = self.start
+    def get_max_r(self, gas=None, window_s=180, step_s=20):
+        """
+        Find the window with the highest pearsons R between close and open.
+
+        Every window start is scored at once from cumulative sums, so the
+        step can be made small. The whole r curve is kept in r_curves.
+
+        returns:
+        ---
+        offsets of the window starts from start in seconds and their r values
+        """
+        if gas is None:
+            for gas in ["CH4", "CO2"]:
+                self.get_max_r(gas, window_s, step_s)
+            return self.r_curves.get("CH4")
+
+        offsets = np.empty(0)
+        r = np.empty(0)
+        df = self.calc_data
+        if df is not None and not df.empty:
+            starts, r = sliding_pearsons_r(
+                df.index.asi8,
+                df[gas].to_numpy(dtype=float),
+                window=window_s * 10**9,
+                step=step_s * 10**9,
+                # same 90 % coverage requirement as before at 1 Hz
+                min_count=window_s * 0.9,
+            )
+            offsets = (starts - self.start.value) / 1e9
+        self.r_curves[gas] = (offsets, r)
+
+        if len(r) == 0 or np.isnan(r).all():
             max_r = 0
-        max_r_offset = (max_r_idx - self.start).total_seconds()
+            max_r_offset = 0.0
+        else:
+            i = np.nanargmax(r)
+            max_r = r[i]
+            max_r_offset = offsets[i]
+        logger.debug(max_r)
+        logger.debug(max_r_offset)
         if gas == "CH4":
             self.ch4_r = max_r
             self.ch4_r_offset = max_r_offset
@@ -242,3 +281,82 @@ class MeasurementCycle:
         if gas == "CO2":
             self.co2_r = max_r
             self.co2_r_offset = max_r_offset
+        return offsets, r
+
+
+def group_cycles(cycles, by="day", max_gap=pd.Timedelta(seconds=1)):
+    """
+    Group cycles so that each group can be fetched with one query.
+
+    args:
+    ---
+    cycles -- list of MeasurementCycle
+    by -- str
+        "day" for one group per UTC day, "span" for one group per contiguous
+        run of cycles
+    max_gap -- pd.Timedelta
+        largest gap between the end of a cycle and the start of the next one
+        that is still considered contiguous with by="span"
+
+    returns:
+    ---
+    list of lists of MeasurementCycle, sorted by start
+    """
+    groups = []
+    group_end = None
+    group_day = None
+    for cycle in sorted(cycles, key=lambda x: x.start):
+        day = cycle.start.floor("D")
+        if by == "day":
+            new_group = day != group_day
+        else:
+            new_group = group_end is None or cycle.start - group_end > max_gap
+        if new_group:
+            groups.append([])
+            group_day = day
+            group_end = cycle.end
+        groups[-1].append(cycle)
+        group_end = max(group_end, cycle.end)
+    return groups
+
+
+def bulk_get_data(cycles, ifdb_dict, client, by="day"):
+    """
+    Fetch LI-COR data for many cycles with one query per group of cycles and
+    hand each cycle its slice of the shared result.
+
+    Cycles that already have data are skipped.
+
+    args:
+    ---
+    cycles -- list of MeasurementCycle
+    ifdb_dict -- dict
+        influxdb config
+    client -- influxdb_client.InfluxDBClient
+    by -- str
+        grouping passed to group_cycles
+    """
+    todo = [cycle for cycle in cycles if cycle.data is None]
+    groups = group_cycles(todo, by=by)
+    logger.debug(f"Fetching {len(todo)} cycles with {len(groups)} queries.")
+    # the uncached groups are queried concurrently, the reads below hit the cache
+    ranges = [(g[0].start, max(cycle.end for cycle in g)) for g in groups]
+    get_cache(ifdb_dict).warm(ifdb_dict, LICOR_MEAS, ranges)
+    for group in groups:
+        start = group[0].start
+        end = max(cycle.end for cycle in group)
+        data = cached_read(ifdb_dict, LICOR_MEAS, client, start_ts=start, stop_ts=end)
+        if data is None or data.empty:
+            for cycle in group:
+                cycle.set_data(None)
+            continue
+        data.set_index("datetime", inplace=True)
+        data.index = pd.to_datetime(data.index)
+        if not data.index.is_monotonic_increasing:
+            data.sort_index(inplace=True)
+        for cycle in group:
+            s, e = get_datetime_index(data, cycle, s_key="start", e_key="end")
+            if s == e:
+                cycle.set_data(None)
+                continue
+            cycle.set_data(data.iloc[s:e].copy())
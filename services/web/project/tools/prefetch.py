@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("defaultLogger")
+
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", 2))
+# cycles loaded on both sides of the current one
+PREFETCH_AHEAD = int(os.getenv("PREFETCH_AHEAD", 3))
+# loads waiting in the pool, more than this and new ones are dropped
+MAX_PENDING = int(os.getenv("PREFETCH_MAX_PENDING", 16))
+
+
+def cycle_key(cycle):
+    return (cycle.id, cycle.start.value)
+
+
+class Prefetcher:
+    """
+    Loads the data of the cycles around the current one in the background.
+
+    get_data also finds the lag and max r, so a prefetched cycle is ready to
+    be drawn. Every cycle is queued at most once at a time. A callback that
+    needs a cycle that is being loaded here blocks on the load lock of the
+    cycle in get_data and uses the result instead of reading it again.
+    """
+
+    def __init__(self, ifdb_dict, workers=PREFETCH_WORKERS, ahead=PREFETCH_AHEAD):
+        self.ifdb_dict = ifdb_dict
+        self.workers = workers
+        self.ahead = ahead
+        self._pool = None
+        self._inflight = {}
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._pool = None
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def prefetch(self, measurements, index):
+        """
+        Queue the next and previous cycles of a CycleSelection, nearest
+        first, alternating forwards and backwards.
+        """
+        n = len(measurements)
+        if n < 2:
+            return
+        order = []
+        for step in range(1, self.ahead + 1):
+            for i in ((index + step) % n, (index - step) % n):
+                if i != index and i not in order:
+                    order.append(i)
+        for i in order:
+            self.submit(measurements[i].cycle())
+
+    def submit(self, cycle):
+        if cycle.data is not None or cycle.no_data_in_db:
+            return
+        key = cycle_key(cycle)
+        with self._lock:
+            if key in self._inflight or len(self._inflight) >= MAX_PENDING:
+                return
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="prefetch"
+                )
+            self._inflight[key] = self._pool.submit(self._load, cycle, key)
+
+    def _load(self, cycle, key):
+        try:
+            cycle.get_data(self.ifdb_dict)
+        except Exception as e:
+            logger.warning(f"Prefetching {key} failed: {e}")
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import logging
+import warnings
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("defaultLogger")
+
+MIN_R = 0.6
+# share of seconds between close and open that can be missing
+MAX_MISSING = 0.1
+MONOTONIC_BIN_S = 20
+# upper limits of the LI-COR analyzer range, CH4 in ppb and CO2 in ppm
+SATURATION = {"CH4": 100000, "CO2": 10000}
+
+# rule name -> what makes a cycle fail it, evaluated on cycle_stats
+QUALITY_RULES = {
+    "diag": lambda s: s["diag_sum"] != 0,
+    "monotonic": lambda s: s["monotonic"],
+    "low_r": lambda s: s["ch4_r"] < MIN_R,
+    "missing": lambda s: s["missing"] > MAX_MISSING,
+    "saturated": lambda s: s["saturated"],
+}
+
+
+def monotonic_bins(values, bin_s=MONOTONIC_BIN_S):
+    """
+    True for rows whose bin means only go up or only go down, like
+    resample(f"{bin_s}s").mean().is_monotonic_* on each cycle. Empty bins
+    at the ends are left out, empty bins in between break the trend.
+    """
+    n, length = values.shape
+    length -= length % bin_s
+    with warnings.catch_warnings():
+        # all nan bins are expected
+        warnings.simplefilter("ignore", RuntimeWarning)
+        bins = np.nanmean(values[:, :length].reshape(n, -1, bin_s), axis=2)
+    has = ~np.isnan(bins)
+    pos = np.arange(bins.shape[1])
+    first = np.where(has.any(axis=1), np.argmax(has, axis=1), bins.shape[1])
+    last = bins.shape[1] - 1 - np.argmax(has[:, ::-1], axis=1)
+    inside = (pos >= first[:, None]) & (pos <= last[:, None])
+    gaps = (inside & ~has).any(axis=1)
+
+    d = np.diff(bins, axis=1)
+    both = has[:, 1:] & has[:, :-1]
+    up = np.where(both, d >= 0, True).all(axis=1)
+    down = np.where(both, d <= 0, True).all(axis=1)
+    return (up | down) & ~gaps
+
+
+def cycle_stats(matrix, close, open, ch4_r):
+    """
+    Everything the rules look at, for every cycle of a CycleMatrix at once.
+
+    args:
+    ---
+    matrix -- CycleMatrix
+    close, open -- int or np.array
+        window offsets in seconds from start, close with the lag applied
+    ch4_r -- np.array
+        max pearsons R of CH4 of every cycle
+
+    returns:
+    ---
+    dict of stat name -> np.array
+    """
+    n_rows = len(matrix.starts)
+    close = np.broadcast_to(np.asarray(close), (n_rows,))
+    open = np.broadcast_to(np.asarray(open), (n_rows,))
+    rows = np.arange(matrix.length)
+    window = (rows >= close[:, None]) & (rows < open[:, None])
+    width = np.maximum(open - close, 1)
+
+    saturated = np.zeros(n_rows, dtype=bool)
+    for gas, limit in SATURATION.items():
+        if gas in matrix.values:
+            with np.errstate(invalid="ignore"):
+                saturated |= ((matrix.values[gas] >= limit) & window).any(axis=1)
+
+    return {
+        "diag_sum": matrix.diag_sum(close, open),
+        "monotonic": monotonic_bins(matrix.values["CH4"]),
+        "ch4_r": np.asarray(ch4_r, dtype=float),
+        "missing": 1 - (matrix.mask & window).sum(axis=1) / width,
+        "saturated": saturated,
+    }
+
+
+def evaluate_rules(matrix, close, open, ch4_r, rules=QUALITY_RULES):
+    """
+    Evaluate the quality rules on every cycle of a CycleMatrix.
+
+    returns:
+    ---
+    pandas.DataFrame with one boolean column per rule, True where the cycle
+    failed it, indexed like matrix.starts
+    """
+    stats = cycle_stats(matrix, close, open, ch4_r)
+    return pd.DataFrame({name: rule(stats) for name, rule in rules.items()})
+
+
+def failed_rules(failed):
+    """List of the failed rule names of every row of evaluate_rules."""
+    names = np.array(failed.columns)
+    return [list(names[row]) for row in failed.to_numpy()]
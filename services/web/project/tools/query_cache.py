@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("defaultLogger")
+
+QUERY_CACHE_TTL_S = float(os.getenv("QUERY_CACHE_TTL_S", 60))
+QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", 256 * 1024**2))
+
+
+def normalize_query(query):
+    """Collapse whitespace so that the same query always gives the same key."""
+    return " ".join(query.split())
+
+
+def result_size(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, dict):
+        return sum(getattr(v, "nbytes", 0) for v in value.values())
+    return 0
+
+
+def copy_result(value):
+    # callers modify the frames they get (set_index inplace etc.)
+    if isinstance(value, pd.DataFrame):
+        return value.copy()
+    if isinstance(value, dict):
+        return {
+            k: v.copy() if isinstance(v, np.ndarray) else v for k, v in value.items()
+        }
+    return value
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class QueryCache:
+    """
+    In-memory cache of query results with a TTL and a size budget.
+
+    Concurrent requests for the same key are single-flighted: the first one
+    runs the loader and the others wait for its result. None results are not
+    cached since read_ifdb also returns None when the query fails.
+    """
+
+    def __init__(self, ttl=QUERY_CACHE_TTL_S, max_bytes=QUERY_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, loader):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, size, value = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    logger.debug("Query cache hit.")
+                    return copy_result(value)
+                self._drop(key)
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._inflight[key] = call
+
+        if not leader:
+            logger.debug("Waiting for identical query in flight.")
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return copy_result(call.value)
+
+        try:
+            call.value = loader()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+                if call.error is None and call.value is not None:
+                    self._put(key, call.value)
+            call.event.set()
+        return copy_result(call.value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _put(self, key, value):
+        size = result_size(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (time.monotonic() + self.ttl, size, value)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+
+query_cache = QueryCache()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from project.tools.client_pool import get_client
+from project.tools.cycle_matrix import CycleMatrix
+from project.tools.ifdb_writer import get_writer
+from project.tools.influxdb_funcs import ifdb_push
+from project.tools.licor_cache import cached_read
+from project.tools.measurement import LICOR_MEAS
+from project.tools.results_store import RESULT_FIELDS, save_rows, to_naive_utc
+
+logger = logging.getLogger("defaultLogger")
+
+# rows collected before they are handed to the writer
+PUSH_BATCH = int(os.getenv("REPROCESS_PUSH_BATCH", 5000))
+
+
+def process_day(read_dict, rows):
+    """
+    Calculate lag, r and validity of the cycles of one day at once with a
+    CycleMatrix.
+
+    The data of the day is fetched with one read, runs in a worker process.
+
+    args:
+    ---
+    read_dict -- dict
+        influxdb config to read from
+    rows -- pandas.DataFrame
+        CycleTable.frame() of the cycles of one day
+
+    returns:
+    ---
+    pandas.DataFrame with the result rows and the original close
+    """
+    rows = rows.sort_values("start")
+    data = cached_read(
+        read_dict,
+        LICOR_MEAS,
+        get_client(read_dict),
+        start_ts=rows["start"].iloc[0],
+        stop_ts=rows["end"].max(),
+    )
+    if data is not None:
+        data = data.set_index(pd.to_datetime(data["datetime"], utc=True))
+        data = data.sort_index()
+
+    start = pd.DatetimeIndex(rows["start"])
+    # frame() close has the lag in it, the cycles are processed from scratch
+    close = (pd.DatetimeIndex(rows["close"]).asi8 - start.asi8) / 1e9
+    close = np.rint(close - rows["lagtime_s"].to_numpy()).astype(np.int64)
+    open = (pd.DatetimeIndex(rows["open"]).asi8 - start.asi8) // 10**9
+    matrix = CycleMatrix.from_frame(data, start.asi8, rows["chamber"].to_numpy())
+    results = matrix.compute(close, open)
+
+    df = pd.DataFrame(
+        {
+            "chamber": rows["chamber"].astype(int).to_numpy(),
+            "start": [to_naive_utc(ts) for ts in start],
+            "close": start + pd.to_timedelta(close, unit="s"),
+            "close_offset": close,
+            "open_offset": open,
+            "manual_valid": None,
+        }
+    )
+    for field in RESULT_FIELDS:
+        if field in results.columns:
+            df[field] = results[field].to_numpy()
+    return df[["chamber", "start", "close"] + RESULT_FIELDS]
+
+
+def push_results(df, push_dict):
+    """
+    Store the results and push them as flux_point rows like push_all_data,
+    keyed by og close. Manual validity flags in the store are kept.
+    """
+    rows = df.drop(columns="close").replace({np.nan: None}).to_dict("records")
+    save_rows(rows, keep_manual=True)
+    df = df.assign(lagtime=df["lagtime_s"], id=df["chamber"])
+    df = df.set_index("close")[["lagtime", "id", "chamber", "ch4_r", "co2_r"]]
+    ifdb_push(df, push_dict, ["chamber"])
+
+
+def reprocess(rows, read_dict, push_dict, workers=None, progress=print):
+    """
+    Recalculate lag, r and validity of many cycles on every core.
+
+    The cycles are split by UTC day, each day goes to one worker and the
+    results are saved to the results store and pushed in batches of
+    PUSH_BATCH rows as days finish.
+
+    args:
+    ---
+    rows -- pandas.DataFrame
+        CycleTable.frame() of the cycles
+    read_dict, push_dict -- dict
+        influxdb configs to read from and push to
+    workers -- int
+        number of processes, defaults to the number of cores
+    progress -- callable
+        gets a progress message after every day
+
+    returns:
+    ---
+    pandas.DataFrame of all results
+    """
+    days = [group for _, group in rows.groupby(rows["start"].dt.floor("D"))]
+    workers = workers or os.cpu_count()
+    progress(f"Reprocessing {len(rows)} cycles over {len(days)} days.")
+
+    results = []
+    pending = []
+    pending_rows = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(process_day, read_dict, day): day for day in days}
+        for done, future in enumerate(as_completed(futures), 1):
+            day = futures[future]["start"].iloc[0].date()
+            try:
+                df = future.result()
+            except Exception as e:
+                logger.warning(f"Reprocessing {day} failed: {e}")
+                progress(f"[{done}/{len(days)}] {day} failed: {e}")
+                continue
+            results.append(df)
+            pending.append(df)
+            pending_rows += len(df)
+            if pending_rows >= PUSH_BATCH:
+                push_results(pd.concat(pending), push_dict)
+                pending, pending_rows = [], 0
+            progress(
+                f"[{done}/{len(days)}] {day}: {len(df)} cycles, "
+                f"{int(df['is_valid'].sum())} valid"
+            )
+    if pending:
+        push_results(pd.concat(pending), push_dict)
+    # waits until everything queued has been written or spooled
+    get_writer(push_dict).stop(timeout=None)
+
+    if not results:
+        return pd.DataFrame(columns=["chamber", "start", "close"] + RESULT_FIELDS)
+    return pd.concat(results, ignore_index=True).sort_values("start")
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import logging
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from sqlalchemy.exc import SQLAlchemyError
+
+from project.tools.cycle_table import MANUAL_UNSET
+
+logger = logging.getLogger("defaultLogger")
+
+UPSERT_CHUNK = 1000
+RESULT_FIELDS = [
+    "close_offset",
+    "open_offset",
+    "lagtime_s",
+    "got_lag",
+    "ch4_r",
+    "co2_r",
+    "ch4_r_offset",
+    "co2_r_offset",
+    "is_valid",
+    "has_errors",
+    "no_data_in_db",
+    "manual_valid",
+    "failed_rules",
+]
+
+_table_ready = False
+
+
+def _model():
+    # project/__init__.py imports the dash apps before the models exist
+    from project import CycleResult, db
+
+    global _table_ready
+    if not _table_ready:
+        CycleResult.__table__.create(db.engine, checkfirst=True)
+        _table_ready = True
+    return db, CycleResult
+
+
+def to_naive_utc(ts):
+    return pd.Timestamp(ts).tz_convert("UTC").tz_localize(None).to_pydatetime()
+
+
+def cycle_to_row(cycle):
+    return {
+        "chamber": int(cycle.id),
+        "start": to_naive_utc(cycle.start),
+        "close_offset": int(cycle.close_offset),
+        "open_offset": int(cycle.open_offset),
+        "lagtime_s": float(cycle.lagtime_s),
+        "got_lag": bool(cycle.got_lag),
+        "ch4_r": float(cycle.ch4_r),
+        "co2_r": float(cycle.co2_r),
+        "ch4_r_offset": float(cycle.ch4_r_offset),
+        "co2_r_offset": float(cycle.co2_r_offset),
+        "is_valid": bool(cycle.is_valid),
+        "has_errors": bool(cycle.has_errors),
+        "no_data_in_db": bool(cycle.no_data_in_db),
+        "manual_valid": cycle.manual_valid,
+        "failed_rules": ",".join(cycle.failed_rules),
+    }
+
+
+def upsert_statement(db, model, fields):
+    dialect = db.engine.dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    stmt = insert(model)
+    return stmt.on_conflict_do_update(
+        index_elements=["chamber", "start"],
+        set_={
+            **{f: stmt.excluded[f] for f in fields},
+            "updated_at": stmt.excluded.updated_at,
+        },
+    )
+
+
+def save_rows(rows, keep_manual=False):
+    """
+    Insert or update result rows keyed by (chamber, start) in chunks of
+    UPSERT_CHUNK, with keep_manual the stored manual_valid flags are not
+    touched. Returns the number of rows written.
+    """
+    if not rows:
+        return 0
+    now = datetime.utcnow()
+    rows = [{**row, "updated_at": now} for row in rows]
+    fields = [f for f in RESULT_FIELDS if not (keep_manual and f == "manual_valid")]
+    db = None
+    try:
+        db, model = _model()
+        stmt = upsert_statement(db, model, fields)
+        for i in range(0, len(rows), UPSERT_CHUNK):
+            chunk = rows[i : i + UPSERT_CHUNK]
+            if stmt is None:
+                for row in chunk:
+                    db.session.merge(model(**row))
+            else:
+                db.session.execute(stmt, chunk)
+        db.session.commit()
+    except SQLAlchemyError as e:
+        logger.warning(f"Saving {len(rows)} cycle results failed: {e}")
+        if db is not None:
+            db.session.rollback()
+        return 0
+    logger.debug(f"Saved {len(rows)} cycle results.")
+    return len(rows)
+
+
+def save_cycles(cycles):
+    """Store the results of MeasurementCycles."""
+    n = save_rows([cycle_to_row(cycle) for cycle in cycles])
+    if n:
+        now = datetime.utcnow()
+        for cycle in cycles:
+            cycle.stored_at = now
+    return n
+
+
+def refresh_cycle(cycle):
+    """
+    Apply the stored lag, offsets, validity and manual flag to a cycle if
+    they were saved after the cycle was last saved or refreshed here, eg. by
+    another worker. One primary key lookup.
+    """
+    try:
+        db, model = _model()
+        row = db.session.get(model, (int(cycle.id), to_naive_utc(cycle.start)))
+    except SQLAlchemyError as e:
+        logger.warning(f"Refreshing cycle results failed: {e}")
+        return
+    if row is None or (cycle.stored_at and row.updated_at <= cycle.stored_at):
+        return
+    cycle.close_offset = row.close_offset
+    cycle.open_offset = row.open_offset
+    cycle.got_lag = row.got_lag
+    cycle.lagtime_s = row.lagtime_s
+    cycle.is_valid = bool(row.is_valid)
+    cycle.has_errors = bool(row.has_errors)
+    cycle.no_data_in_db = bool(row.no_data_in_db)
+    cycle.failed_rules = [r for r in (row.failed_rules or "").split(",") if r]
+    cycle.manual_valid = row.manual_valid
+    cycle.stored_at = row.updated_at
+
+
+def load_results(start, end, chambers=None):
+    """
+    Stored results of cycles starting in [start, end].
+
+    returns:
+    ---
+    pandas.DataFrame with chamber, start (int64 ns UTC) and RESULT_FIELDS
+    """
+    try:
+        db, model = _model()
+        query = db.select(model).where(
+            model.start >= to_naive_utc(start), model.start <= to_naive_utc(end)
+        )
+        if chambers is not None:
+            query = query.where(model.chamber.in_([int(c) for c in chambers]))
+        rows = db.session.execute(query).scalars().all()
+    except SQLAlchemyError as e:
+        logger.warning(f"Loading cycle results failed: {e}")
+        return None
+    columns = ["chamber", "start"] + RESULT_FIELDS
+    df = pd.DataFrame(
+        [[getattr(r, c) for c in columns] for r in rows], columns=columns
+    )
+    df["start"] = pd.to_datetime(df["start"]).astype("int64")
+    return df
+
+
+def load_into_table(table, idx):
+    """
+    Fill the given rows of a CycleTable from the store, each row is looked
+    up only once and rows with a live MeasurementCycle are left alone.
+    """
+    idx = np.asarray(idx)
+    todo = idx[~table.loaded[idx]]
+    if len(todo) == 0:
+        return
+    table.loaded[todo] = True
+    starts = table.start[todo]
+    df = load_results(
+        pd.Timestamp(starts.min(), tz="UTC"),
+        pd.Timestamp(starts.max(), tz="UTC"),
+        np.unique(table.chamber[todo]),
+    )
+    if df is None or df.empty:
+        return
+
+    rows = pd.DataFrame(
+        {"chamber": table.chamber[todo].astype(int), "start": starts, "row": todo}
+    ).merge(df, on=["chamber", "start"])
+    rows = rows[[not table.is_materialized(i) for i in rows["row"]]]
+    if rows.empty:
+        return
+    i = rows["row"].to_numpy()
+    for field in RESULT_FIELDS:
+        values = rows[field]
+        if field == "manual_valid":
+            values = values.map({True: 1, False: 0}).fillna(MANUAL_UNSET)
+        elif field == "failed_rules":
+            values = values.fillna("")
+        else:
+            values = values.fillna(0)
+        getattr(table, field)[i] = values.to_numpy()
+    logger.debug(f"Loaded {len(rows)} stored cycle results.")
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import fcntl
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+logger = logging.getLogger("defaultLogger")
+
+SESSION_DB = os.getenv("SESSION_DB", "cache/sessions.sqlite")
+SESSION_TTL_S = float(os.getenv("SESSION_TTL_S", 7 * 24 * 3600))
+EXPIRE_EVERY_S = 3600
+# sessions are locked by a byte of the lock file chosen by their id
+LOCK_SLOTS = 2**16
+
+
+class SessionStore:
+    """
+    Dashboard state of each browser session, shared by every worker process.
+
+    States are pickled dicts in a SQLite table keyed by the session id.
+    session() holds a lock for the id for the whole read-modify-write so
+    that concurrent callbacks of one session don't overwrite each other,
+    an fcntl byte range lock between processes and a thread lock for the
+    same byte inside one. Sessions that haven't been used for SESSION_TTL_S
+    are removed.
+    """
+
+    def __init__(self, path=SESSION_DB, ttl=SESSION_TTL_S):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self.ttl = ttl
+        self._thread_locks = {}
+        self._locks_lock = threading.Lock()
+        self._expired = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS sessions "
+                "(id TEXT PRIMARY KEY, state BLOB NOT NULL, updated REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        # a connection per call, sqlite connections can't cross threads or forks
+        return sqlite3.connect(self.path, timeout=30)
+
+    @contextmanager
+    def _lock(self, session_id):
+        slot = zlib.crc32(session_id.encode()) % LOCK_SLOTS
+        # fcntl locks don't exclude threads of one process, and there are at
+        # most LOCK_SLOTS of these
+        with self._locks_lock:
+            thread_lock = self._thread_locks.setdefault(slot, threading.Lock())
+        with thread_lock:
+            with open(self.lock_path, "a") as f:
+                fcntl.lockf(f, fcntl.LOCK_EX, 1, slot)
+                try:
+                    yield
+                finally:
+                    fcntl.lockf(f, fcntl.LOCK_UN, 1, slot)
+
+    def get(self, session_id):
+        """State of the session without locking, {} for unknown sessions."""
+        if not session_id:
+            return {}
+        with self._connect() as con:
+            row = con.execute(
+                "SELECT state FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+        return pickle.loads(row[0]) if row else {}
+
+    def put(self, session_id, state):
+        with self._connect() as con:
+            con.execute(
+                "INSERT OR REPLACE INTO sessions (id, state, updated) VALUES (?, ?, ?)",
+                (session_id, pickle.dumps(state), time.time()),
+            )
+        self._expire()
+
+    @contextmanager
+    def session(self, session_id):
+        """
+        Lock the session and yield its state dict, changes made to it are
+        saved when the block exits without an error. Without a session id
+        the state is a throwaway dict.
+        """
+        if not session_id:
+            yield {}
+            return
+        with self._lock(session_id):
+            state = self.get(session_id)
+            yield state
+            self.put(session_id, state)
+
+    def update(self, session_id, **values):
+        """Set some keys of the state of a session."""
+        with self.session(session_id) as state:
+            state.update(values)
+
+    def _expire(self):
+        now = time.time()
+        if now - self._expired < EXPIRE_EVERY_S:
+            return
+        self._expired = now
+        with self._connect() as con:
+            n = con.execute(
+                "DELETE FROM sessions WHERE updated < ?", (now - self.ttl,)
+            ).rowcount
+        if n:
+            logger.debug(f"Removed {n} expired sessions.")
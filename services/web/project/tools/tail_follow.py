@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+
+import pandas as pd
+
+from project.tools.client_pool import get_client
+from project.tools.influxdb_funcs import just_read, mk_newest_ts_q
+
+logger = logging.getLogger("defaultLogger")
+
+# polls closer to each other than this return without querying
+MIN_POLL_S = 20
+# data that ends this close to the end of a cycle covers the whole cycle
+END_SLACK_S = 5
+
+
+def has_full_data(cycle):
+    """True if the data of the cycle reaches its end."""
+    data = cycle.data
+    if data is None or data.empty:
+        return False
+    return data.index[-1] >= cycle.end - pd.Timedelta(seconds=END_SLACK_S)
+
+
+class TailFollower:
+    """
+    Follows the newest data of one measurement for the current day.
+
+    Each poll only queries the points newer than the last timestamp that has
+    been fetched and appends them to an in-memory series. Cycles whose window
+    is covered by the series are handed their data and marked ready.
+    """
+
+    def __init__(self, ifdb_dict, meas_dict, tz="Europe/Helsinki"):
+        self.ifdb_dict = ifdb_dict
+        self.meas_dict = meas_dict
+        self.tz = tz
+        self.measurement = meas_dict.get("measurement")
+        self.last_ts = {}
+        self.data = None
+        self.day_start = None
+        self._polled = 0
+        self._lock = threading.Lock()
+
+    def newest_ts(self, client):
+        bucket = self.ifdb_dict.get("bucket")
+        fields = list(self.meas_dict.get("fields").split(","))
+        query = mk_newest_ts_q(bucket, self.measurement, fields)
+        tables = client.query_api().query(query)
+        times = [record.get_time() for table in tables for record in table.records]
+        if not times:
+            return None
+        return pd.Timestamp(max(times))
+
+    def poll(self, client=None):
+        """
+        Fetch the points newer than the last fetched timestamp.
+
+        returns:
+        ---
+        pandas.DataFrame of the new rows, None if nothing was fetched
+        """
+        with self._lock:
+            if time.monotonic() - self._polled < MIN_POLL_S:
+                return None
+            self._polled = time.monotonic()
+            client = client or get_client(self.ifdb_dict)
+            self._roll_day()
+
+            last = self.last_ts.get(self.measurement)
+            newest = self.newest_ts(client)
+            if newest is None or (last is not None and newest <= last):
+                return None
+
+            # the query range has second resolution, the overlap is dropped
+            start = self.day_start if last is None else last.floor("s")
+            df = just_read(
+                self.ifdb_dict,
+                self.meas_dict,
+                client,
+                start_ts=start,
+                stop_ts=newest + pd.Timedelta(seconds=1),
+                stream=True,
+            )
+            if df is None:
+                return None
+            df = df.set_index("datetime").sort_index()
+            if last is not None:
+                df = df[df.index > last]
+            if df.empty:
+                return None
+
+            self.data = df if self.data is None else pd.concat([self.data, df])
+            self.last_ts[self.measurement] = df.index[-1]
+            logger.debug(f"Tail: {len(df)} new rows up to {df.index[-1]}.")
+            return df
+
+    def ready_cycles(self, cycles):
+        """
+        Mark the cycles of today whose window has completed as ready and give
+        them their slice of the followed data.
+
+        returns:
+        ---
+        list of the cycles that became ready
+        """
+        last = self.last_ts.get(self.measurement)
+        if last is None or self.data is None:
+            return []
+        ready = []
+        for cycle in cycles:
+            if cycle.is_ready or cycle.start < self.day_start or cycle.end > last:
+                continue
+            cycle.is_ready = True
+            # data loaded while the cycle was still running is cut short
+            if not has_full_data(cycle):
+                s = self.data.index.searchsorted(cycle.start, side="left")
+                e = self.data.index.searchsorted(cycle.end, side="left")
+                cycle.set_data(self.data.iloc[s:e].copy() if s < e else None)
+            ready.append(cycle)
+        if ready:
+            logger.debug(f"{len(ready)} cycles ready.")
+        return ready
+
+    def _roll_day(self):
+        day_start = pd.Timestamp.now(tz=self.tz).normalize().tz_convert("UTC")
+        if day_start != self.day_start:
+            self.day_start = day_start
+            self.last_ts.pop(self.measurement, None)
+            self.data = None
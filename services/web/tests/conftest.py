@@ -0,0 +1,50 @@
+import os
+import sys
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "project")
+
+# importing project builds the whole flask app, the tools are tested without it
+if "project" not in sys.modules:
+    project = types.ModuleType("project")
+    project.__path__ = [PROJECT_DIR]
+    sys.modules["project"] = project
+
+
+def make_cycles(close, open, peaks, seed=0):
+    """
+    1 Hz LI-COR like data of consecutive 15 minute cycles.
+
+    The gases are flat until close, rise until open + peak and fall after
+    that, so the lag of every cycle is its peak.
+
+    returns:
+    ---
+    (data, starts), data indexed by UTC datetime like the cached reads
+    """
+    rng = np.random.default_rng(seed)
+    starts = pd.date_range("2024-06-01", periods=len(peaks), freq="15min", tz="UTC")
+    frames = []
+    for start, c, o, peak in zip(starts, close, open, peaks):
+        t = np.arange(899)
+        rise = np.clip(t - c, 0, None) - 2 * np.clip(t - (o + peak), 0, None)
+        frames.append(
+            pd.DataFrame(
+                {
+                    "CH4": 2000 + 0.8 * rise + rng.normal(0, 0.05, len(t)),
+                    "CO2": 420 + 0.05 * rise + rng.normal(0, 0.005, len(t)),
+                    "DIAG": np.zeros(len(t), dtype=int),
+                },
+                index=start + pd.to_timedelta(t, unit="s"),
+            )
+        )
+    return pd.concat(frames), starts
+
+
+@pytest.fixture
+def cycles():
+    return make_cycles
@@ -0,0 +1,46 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+from project.tools.cycle_calendar import CycleCalendar
+
+CYCLE_JSON = os.path.join(os.path.dirname(__file__), "..", "project", "cycle.json")
+
+
+@pytest.fixture
+def calendar():
+    with open(CYCLE_JSON) as f:
+        return CycleCalendar(json.load(f)["CYCLE"])
+
+
+@pytest.mark.parametrize(
+    "ts",
+    [
+        "2024-06-01 10:20:30",
+        # 03:05 local time twice, in summer and in winter time
+        "2024-10-27 00:05:00",
+        "2024-10-27 01:05:00",
+        # the first and the last second of a cycle
+        "2024-10-27 01:15:00",
+        "2024-10-27 01:29:59",
+    ],
+)
+def test_locate_matches_table(calendar, ts):
+    ts = pd.Timestamp(ts, tz="UTC")
+    day = pd.Timedelta(days=1)
+    table = calendar.table(ts - day, ts + day)
+
+    chamber, start = calendar.locate(ts)
+
+    row = table.find(ts)
+    assert start.value == table.start[row]
+    assert chamber == table.chamber[row]
+    assert start <= ts <= start + pd.Timedelta(seconds=899)
+
+
+def test_locate_takes_naive_utc(calendar):
+    assert calendar.locate("2024-10-27 00:05:00") == calendar.locate(
+        pd.Timestamp("2024-10-27 00:05:00", tz="UTC")
+    )
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from project.tools.cycle_matrix import CycleMatrix
+from project.tools.gas_funcs import calculate_pearsons_r, calculate_slope
+
+CLOSE = np.array([240, 250, 240, 260])
+OPEN = np.array([720, 700, 720, 710])
+PEAKS = [20, 35, 50, 65]
+
+
+def seconds(data, start):
+    """Rows of one cycle and their offsets from start in seconds."""
+    df = data[(data.index >= start) & (data.index < start + np.timedelta64(900, "s"))]
+    return ((df.index - start).total_seconds()).to_numpy(), df
+
+
+def test_compute_matches_per_cycle_funcs(cycles):
+    data, starts = cycles(CLOSE, OPEN, PEAKS)
+    # a gap in the second cycle leaves some windows without enough data
+    gap = (data.index >= starts[1] + np.timedelta64(400, "s")) & (
+        data.index < starts[1] + np.timedelta64(440, "s")
+    )
+    data = data[~gap]
+
+    matrix = CycleMatrix.from_frame(data, starts.asi8, np.arange(len(starts)))
+    results = matrix.compute(CLOSE, OPEN)
+
+    np.testing.assert_array_equal(results["lagtime_s"], PEAKS)
+    assert results["got_lag"].all()
+    for i, start in enumerate(starts):
+        x, df = seconds(data, start)
+        inside = (x >= CLOSE[i]) & (x < OPEN[i])
+        for gas in ["CH4", "CO2"]:
+            y = df[gas].to_numpy()
+            assert results[f"{gas.lower()}_slope"].iloc[i] == pytest.approx(
+                calculate_slope(x[inside], y[inside]), rel=1e-6
+            )
+
+            # best window like get_max_r, from the first second with data
+            def r_at(lo):
+                window = (x >= lo) & (x < min(lo + 180, OPEN[i]))
+                if window.sum() <= 180 * 0.9:
+                    return 0
+                return calculate_pearsons_r(x[window], y[window])
+
+            first, last = x[inside][0], x[inside][-1]
+            best = max(r_at(lo) for lo in np.arange(first, last + 1, 20))
+            offset = results[f"{gas.lower()}_r_offset"].iloc[i]
+            assert (offset - first) % 20 == 0
+            assert results[f"{gas.lower()}_r"].iloc[i] == pytest.approx(best, abs=1e-6)
+            assert r_at(offset) == pytest.approx(best, abs=1e-6)
+
+
+def test_compute_without_data(cycles):
+    data, starts = cycles(CLOSE, OPEN, PEAKS)
+    # nothing after open in the third cycle and nothing at all in the last
+    end = starts[2] + np.timedelta64(int(OPEN[2]), "s")
+    data = data[data.index < end]
+
+    results = CycleMatrix.from_frame(data, starts.asi8).compute(CLOSE, OPEN)
+
+    assert list(results["got_lag"]) == [True, True, False, False]
+    assert list(results["no_data_in_db"]) == [False, False, False, True]
+    assert not results["is_valid"].iloc[2:].any()
+    assert (results["failed_rules"].iloc[2:] == "").all()
+    assert (results["lagtime_s"].iloc[2:] == 0).all()
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+from project.tools.cycle_table import NS, CycleTable
+
+
+def make_table(n=3):
+    start = pd.Timestamp("2024-06-01", tz="UTC").value + np.arange(n) * 900 * NS
+    return CycleTable(
+        np.arange(1, n + 1), start, start + 240 * NS, start + 720 * NS, start + 899 * NS
+    )
+
+
+def test_cycle_restores_stored_results():
+    table = make_table()
+    table.got_lag[1] = True
+    table.lagtime_s[1] = 25
+    table.is_valid[1] = False
+    table.has_errors[1] = True
+    table.no_data_in_db[1] = False
+    table.failed_rules[1] = "diag,missing"
+    table.manual_valid[1] = 1
+
+    cycle = table.cycle(1)
+
+    assert cycle.lagtime_s == 25
+    assert cycle.is_valid is False
+    assert cycle.has_errors is True
+    assert cycle.failed_rules == ["diag", "missing"]
+    assert cycle.manual_valid is True
+    assert table.cycle(0).is_valid is True
+    assert table.cycle(0).failed_rules == []
+
+
+def test_sync_round_trips():
+    table = make_table()
+    cycle = table.cycle(2)
+    cycle.is_valid = False
+    cycle.no_data_in_db = True
+    cycle.failed_rules = ["low_r"]
+    table.sync(2)
+
+    other = make_table()
+    for field in ["is_valid", "no_data_in_db", "failed_rules"]:
+        getattr(other, field)[2] = getattr(table, field)[2]
+    restored = other.cycle(2)
+
+    assert restored.is_valid is False
+    assert restored.no_data_in_db is True
+    assert restored.failed_rules == ["low_r"]
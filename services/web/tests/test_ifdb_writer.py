@@ -0,0 +1,31 @@
+import multiprocessing
+
+from project.tools import ifdb_writer
+
+IFDB = {"url": "http://localhost:8086", "organization": "org", "bucket": "test"}
+
+
+def spool_batches(n):
+    writer = ifdb_writer.IfdbWriter(IFDB)
+    for i in range(n):
+        writer._spool([f"m value={i}"])
+
+
+def test_replay_while_another_process_spools(tmp_path, monkeypatch):
+    monkeypatch.setattr(ifdb_writer, "SPOOL_DIR", str(tmp_path))
+    written = []
+    writer = ifdb_writer.IfdbWriter(IFDB)
+    monkeypatch.setattr(
+        writer, "_write", lambda lines: written.extend(lines) or ifdb_writer.WRITTEN
+    )
+
+    n = 300
+    other = multiprocessing.get_context("fork").Process(target=spool_batches, args=(n,))
+    other.start()
+    while other.is_alive():
+        writer._replay()
+    other.join()
+    writer._replay()
+
+    assert sorted(written) == sorted(f"m value={i}" for i in range(n))
+    assert not any(p.name.endswith(".replay") for p in tmp_path.iterdir())
@@ -0,0 +1,52 @@
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from project.tools import measurement as measurement_module
+from project.tools.measurement import MeasurementCycle
+from project.tools.prefetch import Prefetcher
+
+
+@pytest.fixture
+def slow_cycle(cycles, monkeypatch):
+    """A cycle whose read takes 0.2 s, the reads and an event set on the first."""
+    data, starts = cycles([240], [720], [30])
+    reads = []
+    started = threading.Event()
+
+    def cached_read(ifdb_dict, meas_dict, client=None, start_ts=None, stop_ts=None):
+        reads.append(start_ts)
+        started.set()
+        time.sleep(0.2)
+        return data.rename_axis("datetime").reset_index()
+
+    monkeypatch.setattr(measurement_module, "cached_read", cached_read)
+    start = starts[0]
+    cycle = MeasurementCycle(1, start, None, None, start + pd.Timedelta(seconds=899))
+    return cycle, reads, started
+
+
+def test_data_is_set_with_its_results(slow_cycle):
+    cycle, reads, started = slow_cycle
+    Prefetcher({}).submit(cycle)
+    started.wait(1)
+    while cycle.data is None:
+        time.sleep(0.001)
+
+    assert cycle.got_lag is True
+    assert cycle.lagtime_s == 30
+    assert cycle.is_valid is True
+    cycle.get_data({})
+    assert len(reads) == 1
+
+
+def test_callback_waits_for_running_prefetch(slow_cycle):
+    cycle, reads, started = slow_cycle
+    Prefetcher({}).submit(cycle)
+    started.wait(1)
+    cycle.get_data({})
+
+    assert len(reads) == 1
+    assert cycle.lagtime_s == 30
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+
+from project.tools.cycle_matrix import CycleMatrix
+from project.tools.filter import get_datetime_index
+from project.tools.measurement import MeasurementCycle
+
+
+def seconds(starts, i, lo, hi):
+    return (starts[i] + np.timedelta64(lo, "s"), starts[i] + np.timedelta64(hi, "s"))
+
+
+def test_matrix_matches_check_quality(cycles):
+    n = 7
+    data, starts = cycles([240] * n, [720] * n, [10, 20, 30, 40, 50, 60, 70])
+    t = data.index
+
+    def between(i, lo, hi):
+        a, b = seconds(starts, i, lo, hi)
+        return (t >= a) & (t < b)
+
+    # 1: diagnostics, 2: 60 s missing, 3: only noise, 4: saturated,
+    # 5: nothing after open, 6: no data at all, 0 passes everything
+    data.loc[between(1, 300, 310), "DIAG"] = 32
+    data.loc[between(3, 240, 720), "CH4"] = 2000 + np.random.default_rng(1).normal(
+        0, 1, 480
+    )
+    data.loc[between(4, 600, 620), "CH4"] = 100000
+    data = data[~between(2, 400, 460) & ~between(5, 720, 900) & ~between(6, 0, 900)]
+
+    results = CycleMatrix.from_frame(data, starts.asi8, np.arange(n)).compute()
+
+    for i, start in enumerate(starts):
+        cycle = MeasurementCycle(
+            i, start, None, None, start + pd.Timedelta(seconds=899)
+        )
+        s, e = get_datetime_index(data, cycle, s_key="start", e_key="end")
+        cycle.set_data(None if s == e else data.iloc[s:e].copy())
+        row = results.iloc[i]
+
+        assert row["is_valid"] == cycle.is_valid, i
+        assert row["failed_rules"] == ",".join(cycle.failed_rules), i
+        assert row["has_errors"] == cycle.has_errors, i
+        assert row["no_data_in_db"] == cycle.no_data_in_db, i
+        assert row["got_lag"] == bool(cycle.got_lag), i
+        assert row["lagtime_s"] == cycle.lagtime_s, i
+
+    assert list(results["is_valid"]) == [True] + [False] * (n - 1)
+    assert list(results["failed_rules"]) == [
+        "",
+        "diag",
+        "missing",
+        "low_r",
+        "saturated",
+        "",
+        "",
+    ]
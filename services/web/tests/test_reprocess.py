@@ -0,0 +1,29 @@
+import numpy as np
+
+from project.tools import reprocess
+from project.tools.cycle_table import CycleTable
+
+
+def test_process_day(cycles, monkeypatch):
+    close, open, peaks = [240] * 3, [720] * 3, [20, 30, 40]
+    data, starts = cycles(close, open, peaks)
+    reads = []
+
+    def cached_read(read_dict, meas_dict, client=None, start_ts=None, stop_ts=None):
+        reads.append((start_ts, stop_ts))
+        return data.rename_axis("datetime").reset_index()
+
+    monkeypatch.setattr(reprocess, "cached_read", cached_read)
+    monkeypatch.setattr(reprocess, "get_client", lambda read_dict: None)
+    s = starts.asi8
+    table = CycleTable([1, 2, 3], s, s + 240 * 10**9, s + 720 * 10**9, s + 899 * 10**9)
+    table.lagtime_s[:] = 15
+
+    df = reprocess.process_day({}, table.frame()[::-1])
+
+    assert len(reads) == 1
+    assert list(df["chamber"]) == [1, 2, 3]
+    np.testing.assert_array_equal(df["lagtime_s"], peaks)
+    assert list(df["close_offset"]) == close
+    assert list(df["close"]) == list(starts + np.timedelta64(240, "s"))
+    assert df["is_valid"].all()